@@ -1,16 +1,26 @@
+import hmac
 import os
+import re
 from functools import wraps
-from re import compile
 
-from jinja2 import Environment, TemplateNotFound
+from jinja2 import TemplateNotFound
 
-from prometheus_client import Counter, REGISTRY, Summary, exposition
+from prometheus_client import Counter, Histogram, exposition
 
+import tornado.escape
+import tornado.routing
 import tornado.web
 
-import yaml
-
+from .assets import AssetHandler
+from .export import exportable, load_export
+from .metrics import (LabelLimiter,
+                      get_registry,
+                      method_label,
+                      status_class)
 from .mitte import EngineMixin
+from .prefetch import Prefetcher  # noqa: F401
+from .profiler import MIN_INTERVAL, SamplingProfiler
+from .site import SiteReloader, init_site  # noqa: F401
 
 
 def force_https(f):
@@ -60,27 +70,47 @@ def secure_headers(f):
     return wrapper
 
 
-def init_site(site_path):
-    with open(site_path) as f:
-        t = Environment().from_string(f.read())
-        site = yaml.full_load(t.render(environ=os.environ))
-
-    site['routes'] = list(map(lambda page: compile(page), site['pages']))
-
-    return site
-
-
 class PageHandler(EngineMixin, tornado.web.RequestHandler):
-    request_time = Summary(
-        'request_processing_seconds', 'Time spent processing request')
     request_total = Counter(
-        'request_total', 'HTTP Requests', ['method', 'uri'])
+        'request_total', 'HTTP Requests', ['method', 'route', 'status'])
+    request_duration = Histogram(
+        'request_duration_seconds', 'Time spent processing request',
+        ['route'])
     error_total = Counter(
-        'error_total', 'HTTP Errors', ['method', 'uri', 'status'])
+        'error_total', 'HTTP Errors', ['method', 'route', 'status'])
+    phase_duration = Histogram(
+        'request_phase_seconds', 'Time spent in each phase of a request',
+        ['route', 'phase'],
+        buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5,
+                 1, 2.5, 5, 10))
+
+    route = None
+    route_label = LabelLimiter()
+
+    def get_metric_labels(self):
+        method = method_label(self.request.method, self.SUPPORTED_METHODS)
+        route = 'unmatched' if self.route is None else self.route
+        return method, self.route_label(route)
+
+    def on_finish(self):
+        method, route = self.get_metric_labels()
+        self.request_total.labels(
+            method, route, status_class(self.get_status())).inc()
+        self.request_duration.labels(route).observe(
+            self.request.request_time())
+        for phase, _, duration in self.timer.phases:
+            self.phase_duration.labels(route, phase).observe(duration)
+
+    def flush(self, *args, **kwargs):
+        # only the first flush sends headers, later phases of a streamed
+        # response are left out
+        if self.settings.get('server_timing') and self.timer.phases:
+            self.set_header('Server-Timing', self.timer.header())
+        return super(PageHandler, self).flush(*args, **kwargs)
 
     def write_error(self, status_code, **kwargs):
-        self.error_total.labels(
-            self.request.method, self.request.uri, status_code).inc()
+        method, route = self.get_metric_labels()
+        self.error_total.labels(method, route, status_code).inc()
 
         # default to status_code template
         tpl_name = f'{status_code}.html'
@@ -103,19 +133,21 @@ class PageHandler(EngineMixin, tornado.web.RequestHandler):
             super(PageHandler, self).write_error(status_code, **kwargs)
         else:
             # return our custom error page
-            error_response = template.render(site=self.site, page=page)
+            error_response = self.render_template(
+                template, site=self.site, page=page)
             self.finish(error_response)
 
-    @request_time.time()
     @tornado.web.removeslash
     @secure_headers
     @force_https
     def prepare(self):
-        self.request_total.labels(self.request.method, self.request.uri).inc()
+        pass
 
     @tornado.gen.coroutine
     def get(self, slug=None):
-        page_slug, page, named_groups = self.get_page(slug)
+        with self.timer.phase('route'):
+            page_slug, page, named_groups = self.get_page(slug)
+        self.route = page_slug
 
         if 'redirect' in page:
             perm = False
@@ -124,13 +156,18 @@ class PageHandler(EngineMixin, tornado.web.RequestHandler):
             self.redirect(page['redirect']['target'], perm)
             raise tornado.web.Finish()
 
+        cache_key = None
+        if 'response_cache' in page:
+            cache_key = self.get_response_cache_key(slug, page)
+            cached = self.engine.response_cache.get(cache_key)
+            if cached is not None:
+                self.write_cached_response(cached)
+                return
+
         data_sources = {}
         if 'data_sources' in page:
-            sources = page['data_sources']
-            for name in sources:
-                data = yield self.get_data(sources[name],
-                                           named_groups=named_groups)
-                data_sources[name] = data
+            data_sources = yield self.get_data_sources(
+                page, named_groups=named_groups)
 
         if 'published' in page and page['published'] is False:
             raise tornado.web.HTTPError(404)
@@ -138,19 +175,187 @@ class PageHandler(EngineMixin, tornado.web.RequestHandler):
         if 'content-type' in page:
             self.set_header("Content-Type", page['content-type'])
 
-        if 'tpl_name' in page:
-            template = self.get_template(page['tpl_name'])
-        else:
-            template = self.get_template_by_slug(slug)
-
-        response = template.render(site=self.site, page=page, **data_sources)
+        with self.timer.phase('template'):
+            if 'tpl_name' in page:
+                template = self.get_template(page['tpl_name'])
+            else:
+                template = self.get_template_by_slug(slug)
+
+        if page.get('stream') and cache_key is None:
+            with self.timer.phase('render'):
+                yield self.stream_template(
+                    template, site=self.site, page=page, **data_sources)
+            return
+
+        with self.timer.phase('render'):
+            response = self.render_template(
+                template, site=self.site, page=page, **data_sources)
+
+        if cache_key is not None:
+            headers = {}
+            if 'content-type' in page:
+                headers['Content-Type'] = page['content-type']
+            cached = self.engine.response_cache.set(
+                cache_key, tornado.escape.utf8(response), headers,
+                page['response_cache'].get('ttl', 60))
+            self.write_cached_response(cached)
+            return
 
         self.finish(response)
 
 
+class ExportMatcher(tornado.routing.PathMatches):
+    """ Matches the path of an exported page as long as the current site
+    still allows exporting it, so pages changed by a site reload are
+    rendered again. """
+
+    def __init__(self, slug):
+        super(ExportMatcher, self).__init__(re.escape(slug) + '$')
+        self.slug = slug
+        self.application = None
+
+    def match(self, request):
+        site = self.application.settings['site']
+        if self.slug not in site['pages'] or not exportable(site, self.slug):
+            return None
+        return super(ExportMatcher, self).match(request)
+
+
+class ExportHandler(AssetHandler):
+    """ Serves a page written by `BER export` from disk, instead of
+    rendering it. """
+
+    def initialize(self, path, slug, filename, content_type):
+        super(ExportHandler, self).initialize(path)
+        self.slug = slug
+        self.filename = filename
+        self.exported_content_type = content_type
+
+    def on_finish(self):
+        route = PageHandler.route_label(self.slug)
+        method = method_label(self.request.method, self.SUPPORTED_METHODS)
+        PageHandler.request_total.labels(
+            method, route, status_class(self.get_status())).inc()
+        PageHandler.request_duration.labels(route).observe(
+            self.request.request_time())
+
+    @secure_headers
+    @force_https
+    def prepare(self):
+        pass
+
+    def get(self, include_body=True):
+        return super(ExportHandler, self).get(self.filename, include_body)
+
+    def head(self):
+        return self.get(include_body=False)
+
+    def get_content_type(self):
+        return self.exported_content_type
+
+    def get_cache_time(self, path, modified, mime_type):
+        # unlike assets, pages don't have versioned urls
+        return 0
+
+
 class MetricsHandler(tornado.web.RequestHandler):
     def get(self):
         encoder, content_type = exposition.choose_encoder(
             self.request.headers.get('Accept'))
         self.set_header('Content-Type', content_type)
-        self.write(encoder(REGISTRY))
+        self.write(encoder(get_registry()))
+
+
+class ProfileHandler(tornado.web.RequestHandler):
+    """ Profiles the process serving the request for `seconds`. Needs the
+    `admin_token` setting, sent as `Authorization: Bearer <token>`. """
+
+    running = False
+
+    def prepare(self):
+        token = self.settings.get('admin_token')
+        if not token:
+            raise tornado.web.HTTPError(404)
+
+        authorization = self.request.headers.get('Authorization', '')
+        if not hmac.compare_digest(
+                tornado.escape.utf8(authorization),
+                tornado.escape.utf8(f'Bearer {token}')):
+            raise tornado.web.HTTPError(403)
+
+    @tornado.gen.coroutine
+    def get(self):
+        max_seconds = self.settings.get('profile_max_seconds', 60)
+        try:
+            seconds = float(self.get_argument('seconds', 5))
+            interval = float(self.get_argument('interval', 0.005))
+            threshold = float(self.get_argument('threshold', 0.1))
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        if not 0 < seconds <= max_seconds or \
+                not interval >= MIN_INTERVAL or not threshold > 0:
+            raise tornado.web.HTTPError(400)
+
+        # samples of concurrent profiles would end up in each other
+        if ProfileHandler.running:
+            raise tornado.web.HTTPError(409)
+        ProfileHandler.running = True
+        try:
+            profiler = SamplingProfiler(interval, threshold)
+            yield profiler.profile(seconds)
+        finally:
+            ProfileHandler.running = False
+
+        if self.get_argument('format', 'collapsed') == 'json':
+            self.write(profiler.to_dict())
+        else:
+            self.set_header('Content-Type', 'text/plain; charset=UTF-8')
+            self.write(profiler.collapsed())
+
+
+def make_settings(site_dir, **settings):
+    defaults = dict(
+        template_path=os.path.join(site_dir, 'templates'),
+        snippet_path=os.path.join(site_dir, 'snippets'),
+        static_path=os.path.join(site_dir, 'assets'),
+        static_url_prefix='/assets/',
+        static_handler_class=AssetHandler,
+        compress_response=True,
+        data_path=os.path.join(site_dir, 'data'),
+        site_path=os.path.join(site_dir, 'site.yaml'),
+        template_bundle=os.path.join(site_dir, 'templates.zip'),
+        export_path=os.path.join(site_dir, 'export'))
+    defaults.update(settings)
+
+    if 'site' not in defaults:
+        defaults['site'] = init_site(defaults['site_path'])
+
+    return defaults
+
+
+def make_app(site_dir, **settings):
+    settings = make_settings(site_dir, **settings)
+
+    handlers = [(settings['static_url_prefix'] + '(.*)',
+                 settings['static_handler_class'],
+                 dict(path=settings['static_path'])),
+                (r"/metrics", MetricsHandler),
+                (r"/admin/profile", ProfileHandler)]
+
+    # exported pages are served as they are, everything else is rendered
+    matchers = []
+    export_path = settings['export_path']
+    if export_path:
+        for slug, entry in sorted(load_export(export_path).items()):
+            matchers.append(ExportMatcher(slug))
+            handlers.append((
+                matchers[-1], ExportHandler,
+                dict(path=export_path, slug=slug, filename=entry['file'],
+                     content_type=entry['content_type'])))
+
+    handlers.append((r"(/[a-z0-9\-_\/\.]*)$", PageHandler))
+
+    application = tornado.web.Application(handlers, **settings)
+    for matcher in matchers:
+        matcher.application = application
+    return application
@@ -0,0 +1,145 @@
+import argparse
+import glob
+import logging
+import os
+import sys
+
+import tornado.httpserver
+import tornado.ioloop
+import tornado.log
+import tornado.netutil
+import tornado.process
+
+from . import Prefetcher, SiteReloader, make_app, make_settings
+from .assets import build_assets
+from .export import export_site
+from .metrics import multiprocess_dir
+from .mitte import Engine
+
+
+log = logging.getLogger(__name__)
+
+
+def build_assets_command(args):
+    engine = Engine(make_settings(args.site_dir))
+    manifest = build_assets(engine)
+    print(f'built {len(manifest)} assets')
+
+
+def compile_templates_command(args):
+    settings = make_settings(args.site_dir)
+    target = args.output or settings['template_bundle']
+    templates = Engine(settings).compile_templates(target)
+    print(f'compiled {templates} templates into {target}')
+
+
+def export_command(args):
+    tornado.log.enable_pretty_logging()
+    settings = make_settings(args.site_dir)
+    target = args.output or settings['export_path']
+    # render everything, not the files of a previous export
+    app = make_app(args.site_dir, site=settings['site'], export_path=None,
+                   force_https=False, compress_response=False)
+    manifest = tornado.ioloop.IOLoop.current().run_sync(
+        lambda: export_site(app, target, args.host, args.protocol))
+    print(f'exported {len(manifest)} pages into {target}')
+
+
+def serve_command(args):
+    tornado.log.enable_pretty_logging()
+    logging.getLogger().setLevel(args.logging.upper())
+
+    metrics_dir = multiprocess_dir()
+    if args.workers != 1:
+        if not metrics_dir:
+            log.warning('PROMETHEUS_MULTIPROC_DIR isn\'t set, /metrics will '
+                        'only report the worker serving the scrape')
+        else:
+            # values left behind by a previous run would be added to ours
+            for path in glob.glob(os.path.join(metrics_dir, '*.db')):
+                os.remove(path)
+
+    app = make_app(args.site_dir, force_https=args.force_https)
+
+    # warm up before forking, so all workers share the compiled templates
+    templates = Engine.for_application(app).warmup()
+    log.info('compiled %d templates, %d routes',
+             templates, len(app.settings['site']['routes']))
+
+    if args.workers != 1:
+        tornado.process.fork_processes(args.workers)
+
+    # every worker binds its own socket, the kernel balances between them
+    sockets = tornado.netutil.bind_sockets(
+        args.port, args.address, reuse_port=args.workers != 1)
+    server = tornado.httpserver.HTTPServer(app, xheaders=True)
+    server.add_sockets(sockets)
+
+    if args.reload_interval:
+        SiteReloader(app, app.settings['site_path'],
+                     args.reload_interval).start()
+
+    # caches are per process, every worker keeps its own warm
+    Prefetcher(app, args.prefetch_concurrency).start()
+
+    tornado.ioloop.IOLoop.current().start()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='BER')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    build = commands.add_parser(
+        'build-assets',
+        help='build and fingerprint static assets, write the manifest')
+    build.add_argument('site_dir')
+    build.set_defaults(func=build_assets_command)
+
+    compile_templates = commands.add_parser(
+        'compile-templates',
+        help='precompile all templates into a bundle loaded at startup')
+    compile_templates.add_argument('site_dir')
+    compile_templates.add_argument(
+        '--output', help='defaults to templates.zip in the site directory')
+    compile_templates.set_defaults(func=compile_templates_command)
+
+    export = commands.add_parser(
+        'export',
+        help='render the pages without data sources or patterns to files '
+             'served instead of rendering them')
+    export.add_argument('site_dir')
+    export.add_argument(
+        '--output', help='defaults to export in the site directory')
+    export.add_argument(
+        '--host', required=True,
+        help='host the pages are rendered for, like www.example.com')
+    export.add_argument('--protocol', default='https')
+    export.set_defaults(func=export_command)
+
+    serve = commands.add_parser('serve', help='serve a site')
+    serve.add_argument('site_dir')
+    serve.add_argument(
+        '--port', type=int, default=int(os.environ.get('PORT', 8000)))
+    serve.add_argument('--address', default='')
+    serve.add_argument(
+        '--workers', type=int, default=1,
+        help='number of worker processes, 0 for one per CPU')
+    serve.add_argument(
+        '--reload-interval', type=float, default=0,
+        help='seconds between checks for site.yaml changes, 0 to disable')
+    serve.add_argument(
+        '--prefetch-concurrency', type=int, default=4,
+        help='data sources with a refresh_interval refreshed at a time')
+    serve.add_argument(
+        '--no-force-https', dest='force_https', action='store_false',
+        help='don\'t redirect plain HTTP requests to HTTPS')
+    serve.add_argument('--logging', default='info')
+    serve.set_defaults(func=serve_command)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
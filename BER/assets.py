@@ -0,0 +1,152 @@
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+
+import tornado.web
+
+from webassets import Bundle
+from webassets.ext.jinja2 import Jinja2Loader
+
+from .compression import EXTENSIONS, accepted_encodings, precompress
+
+
+MANIFEST = 'manifest.json'
+SKIP_DIRS = ('.webassets-cache',)
+FINGERPRINTED = re.compile(r'\.[0-9a-f]{12}(\.[^./]+)?(\.gz|\.br)?$')
+
+
+def fingerprint(path, name):
+    with open(os.path.join(path, name), 'rb') as f:
+        digest = hashlib.md5(f.read()).hexdigest()[:12]
+    root, ext = os.path.splitext(name)
+    return f'{root}.{digest}{ext}'
+
+
+def walk_files(path):
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [d for d in dirs if d not in SKIP_DIRS]
+        for filename in files:
+            name = os.path.relpath(os.path.join(root, filename), path)
+            yield name.replace(os.sep, '/')
+
+
+def static_files(path):
+    for name in walk_files(path):
+        if name == MANIFEST or FINGERPRINTED.search(name):
+            continue
+        if name.endswith(tuple(EXTENSIONS.values())):
+            continue
+        yield name
+
+
+def bundle_sources(bundle, ctx=None):
+    """ The absolute paths of the files a bundle and its nested bundles
+    are built from. """
+
+    for _, source in bundle.resolve_contents(ctx):
+        if isinstance(source, Bundle):
+            yield from bundle_sources(source, ctx or bundle.env)
+        else:
+            yield source
+
+
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except IOError:
+        return None
+
+
+def build_assets(engine):
+    """ Build every webassets bundle used in the templates, copy all static
+    files to content addressed names, write the manifest mapping the
+    original names to them and precompress both. The sources of bundles
+    aren't copied, only what they are built into, and copies the previous
+    build listed in its manifest are removed. """
+
+    settings = engine.settings
+    static_path = settings['static_path']
+    assets_env = engine.template_env.assets_environment
+
+    loader = Jinja2Loader(
+        assets_env,
+        [settings['template_path'], settings['snippet_path']],
+        [engine.template_env])
+    sources = set()
+    for bundle in loader.load_bundles():
+        bundle.env = assets_env
+        bundle.build(force=True)
+        sources.update(os.path.abspath(source)
+                       for source in bundle_sources(bundle))
+
+    manifest = {}
+    for name in sorted(static_files(static_path)):
+        if os.path.abspath(os.path.join(static_path, name)) in sources:
+            continue
+        fingerprinted = fingerprint(static_path, name)
+        shutil.copyfile(os.path.join(static_path, name),
+                        os.path.join(static_path, fingerprinted))
+        manifest[name] = fingerprinted
+
+        precompress(os.path.join(static_path, name))
+        precompress(os.path.join(static_path, fingerprinted))
+
+    # remove copies, and their variants, of files that changed or are gone.
+    # Only the ones a build wrote, the site may have hashed names of its own
+    previous = load_manifest(os.path.join(static_path, MANIFEST)) or {}
+    for name in set(previous.values()) - set(manifest.values()):
+        path = os.path.join(static_path, *name.split('/'))
+        for stale in [path] + [path + ext for ext in EXTENSIONS.values()]:
+            if os.path.exists(stale):
+                os.remove(stale)
+
+    with open(os.path.join(static_path, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+class AssetHandler(tornado.web.StaticFileHandler):
+    """ Serves static files, marking the content addressed copies written
+    by build_assets as immutable and preferring precompressed variants
+    the client accepts. """
+
+    def validate_absolute_path(self, root, absolute_path):
+        absolute_path = super(AssetHandler, self).validate_absolute_path(
+            root, absolute_path)
+        self.original_path = absolute_path
+        self.content_encoding = None
+        if absolute_path is None:
+            return None
+
+        for encoding in accepted_encodings(
+                self.request.headers.get('Accept-Encoding')):
+            compressed = absolute_path + EXTENSIONS[encoding]
+            # a variant older than the file was compressed from an edit ago
+            if os.path.isfile(compressed) and os.path.getmtime(
+                    compressed) >= os.path.getmtime(absolute_path):
+                self.content_encoding = encoding
+                return super(AssetHandler, self).validate_absolute_path(
+                    root, compressed)
+
+        return absolute_path
+
+    def get_content_type(self):
+        if self.content_encoding is None:
+            return super(AssetHandler, self).get_content_type()
+        mime_type, _ = mimetypes.guess_type(self.original_path)
+        return mime_type or 'application/octet-stream'
+
+    def set_extra_headers(self, path):
+        if not self.settings.get('compress_response'):
+            # otherwise added by tornado's gzip transform
+            self.set_header('Vary', 'Accept-Encoding')
+        if self.content_encoding is not None:
+            self.set_header('Content-Encoding', self.content_encoding)
+        if FINGERPRINTED.search(path):
+            self.set_header(
+                'Cache-Control', 'public, max-age=31536000, immutable')
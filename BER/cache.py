@@ -0,0 +1,283 @@
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from time import time
+
+from prometheus_client import Counter, Gauge
+
+import tornado.gen
+import tornado.ioloop
+
+from .compression import MIN_LENGTH, compress, compressible
+
+
+log = logging.getLogger(__name__)
+
+# request attributes a response cache can vary on
+VARY_DIMENSIONS = ('host', 'protocol', 'path', 'arguments')
+DATA_CACHE_SETTINGS = ('ttl', 'stale_ttl', 'max_entries')
+
+
+class LRUCache(object):
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            return default
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.entries.pop(key, default)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class CacheEntry(object):
+    __slots__ = ('value', 'validators', 'expires', 'stale_until')
+
+    def __init__(self, value, validators, ttl, stale_ttl):
+        now = time()
+        self.value = value
+        self.validators = validators
+        self.expires = now + ttl
+        self.stale_until = self.expires + stale_ttl
+
+
+class DataCache(object):
+    lookup_total = Counter(
+        'data_cache_lookup_total', 'Data source cache lookups.', ['result'])
+    refresh_total = Counter(
+        'data_cache_refresh_total',
+        'Background data source cache refreshes.',
+        ['status'])
+
+    def __init__(self, ttl=60, stale_ttl=0, max_entries=128):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.entries = LRUCache(max_entries)
+        self.pending = {}
+
+    @tornado.gen.coroutine
+    def get(self, key, fetch):
+        entry = self.entries.get(key)
+        now = time()
+
+        if entry is not None and now < entry.expires:
+            self.lookup_total.labels('hit').inc()
+            return entry.value
+
+        if entry is not None and now < entry.stale_until:
+            self.lookup_total.labels('stale').inc()
+            if key not in self.pending:
+                tornado.ioloop.IOLoop.current().spawn_callback(
+                    self.refresh, key, fetch)
+            return entry.value
+
+        self.lookup_total.labels('miss').inc()
+        value = yield self.load(key, fetch)
+        return value
+
+    def load(self, key, fetch):
+        # concurrent misses for the same key share one upstream fetch
+        if key not in self.pending:
+            future = self.pending[key] = self.store(key, fetch)
+            future.add_done_callback(lambda f: self.pending.pop(key, None))
+        return self.pending[key]
+
+    @tornado.gen.coroutine
+    def store(self, key, fetch):
+        # fetch gets the previous entry to revalidate against, if any, and
+        # returns the value together with its validators
+        previous = self.entries.get(key)
+        value, validators = yield fetch(previous)
+        self.entries.set(
+            key, CacheEntry(value, validators, self.ttl, self.stale_ttl))
+        return value
+
+    @tornado.gen.coroutine
+    def refresh(self, key, fetch):
+        try:
+            yield self.load(key, fetch)
+        except Exception:
+            # keep serving the stale entry until it runs out
+            self.refresh_total.labels('failure').inc()
+            log.warning('refreshing %s failed', key, exc_info=True)
+        else:
+            self.refresh_total.labels('success').inc()
+
+    def clear(self):
+        self.entries.clear()
+
+
+def compute_etag(body):
+    return '"{0}"'.format(hashlib.sha1(body).hexdigest())
+
+
+class ResponseCacheEntry(object):
+    __slots__ = ('body', 'etag', 'headers', 'expires', 'variants')
+
+    def __init__(self, body, headers, ttl):
+        self.body = body
+        self.etag = compute_etag(body)
+        self.headers = headers
+        self.expires = time() + ttl
+        self.variants = {}
+
+    def compress(self, encoding):
+        content_type = self.headers.get('Content-Type', 'text/html')
+        if len(self.body) < MIN_LENGTH or not compressible(content_type):
+            return None
+        body = compress(self.body, encoding)
+        if len(body) >= len(self.body):
+            return None
+        return body, compute_etag(body)
+
+    def get_variant(self, encodings):
+        """ Return the encoding, body and etag to respond with, compressing
+        the body once per encoding. """
+        for encoding in encodings:
+            if encoding not in self.variants:
+                self.variants[encoding] = self.compress(encoding)
+            variant = self.variants[encoding]
+            if variant is not None:
+                return (encoding,) + variant
+        return None, self.body, self.etag
+
+
+class ResponseCache(object):
+    lookup_total = Counter(
+        'response_cache_lookup_total',
+        'Rendered response cache lookups.',
+        ['result'])
+
+    def __init__(self, max_entries=1024):
+        self.entries = LRUCache(max_entries)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or time() >= entry.expires:
+            self.lookup_total.labels('miss').inc()
+            return None
+        self.lookup_total.labels('hit').inc()
+        return entry
+
+    def set(self, key, body, headers, ttl):
+        entry = ResponseCacheEntry(body, headers, ttl)
+        self.entries.set(key, entry)
+        return entry
+
+    def clear(self):
+        self.entries.clear()
+
+
+def stat_key(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class LocalDataCacheEntry(object):
+    __slots__ = ('value', 'stat')
+
+    def __init__(self, value, stat):
+        self.value = value
+        self.stat = stat
+
+
+class LocalDataCache(object):
+    lookup_total = Counter(
+        'local_data_cache_lookup_total',
+        'Local data source cache lookups.',
+        ['result'])
+    size_bytes = Gauge(
+        'local_data_cache_bytes',
+        'Size of the files held by the local data source cache.',
+        multiprocess_mode='livesum')
+
+    def __init__(self, max_size=64 * 1024 * 1024):
+        # file sizes stand in for the size of the parsed data
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.watcher = None
+
+    @property
+    def watching(self):
+        return self.watcher is not None
+
+    def get(self, path, format, stat=None, projection=None):
+        """ Return the entry for `path` parsed as `format`. Without a
+        watcher, `stat` has to match the entry's (mtime, size). """
+        key = (path, format, projection)
+        entry = self.entries.get(key)
+        if entry is None or (stat is not None and stat != entry.stat):
+            self.lookup_total.labels('miss').inc()
+            return None
+        self.entries.move_to_end(key)
+        self.lookup_total.labels('hit').inc()
+        return entry
+
+    def set(self, path, format, stat, value, projection=None):
+        key = (path, format, projection)
+        self.remove(key)
+        if stat[1] > self.max_size:
+            return
+
+        self.entries[key] = LocalDataCacheEntry(value, stat)
+        self.size += stat[1]
+        while self.size > self.max_size:
+            self.remove(next(iter(self.entries)))
+        self.size_bytes.set(self.size)
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.stat[1]
+            self.size_bytes.set(self.size)
+
+    def invalidate(self, path):
+        for key in [key for key in self.entries if key[0] == path]:
+            self.remove(key)
+
+    def poll(self):
+        for key, entry in list(self.entries.items()):
+            try:
+                stat = stat_key(key[0])
+            except OSError:
+                stat = None
+            if stat != entry.stat:
+                self.remove(key)
+
+    def watch(self, interval):
+        """ Poll the cached files every `interval` seconds and drop changed
+        ones, so lookups don't have to stat files themselves. """
+        self.watcher = tornado.ioloop.PeriodicCallback(
+            self.poll, interval * 1000)
+        self.watcher.start()
+
+    def stop(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+
+    def clear(self):
+        for key in list(self.entries):
+            self.remove(key)
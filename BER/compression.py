@@ -0,0 +1,91 @@
+import gzip
+import mimetypes
+import os
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+
+MIN_LENGTH = 1024
+EXTENSIONS = {'br': '.br', 'gzip': '.gz'}
+COMPRESSIBLE_TYPES = (
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml')
+
+
+def supported_encodings():
+    # in order of preference
+    if brotli is not None:
+        return ('br', 'gzip')
+    return ('gzip',)
+
+
+def accepted_encodings(accept_encoding):
+    """ Return the supported encodings the Accept-Encoding header allows, the
+    client's preferred first. """
+
+    qualities = {}
+    for coding in (accept_encoding or '').split(','):
+        name, _, params = coding.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[name.strip().lower()] = quality
+
+    supported = supported_encodings()
+    accepted = [e for e in supported if qualities.get(e, 0) > 0]
+    return sorted(accepted, key=lambda e: -qualities[e])
+
+
+def compressible(content_type):
+    if content_type is None:
+        return False
+    content_type = content_type.split(';')[0].strip()
+    return (content_type.startswith('text/') or
+            content_type in COMPRESSIBLE_TYPES or
+            content_type.endswith('+xml'))
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data)
+    if encoding == 'gzip':
+        return gzip.compress(data, mtime=0)
+    raise ValueError(f'unsupported encoding {encoding}')
+
+
+def precompress(path):
+    """ Write compressed variants next to `path`, if its type is compressible
+    and compressing actually saves bytes. Variants written for a previous
+    version of the file are removed either way. """
+
+    for extension in EXTENSIONS.values():
+        if os.path.exists(path + extension):
+            os.remove(path + extension)
+
+    content_type, encoding = mimetypes.guess_type(path)
+    if encoding is not None or not compressible(content_type):
+        return []
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < MIN_LENGTH:
+        return []
+
+    written = []
+    for encoding in supported_encodings():
+        compressed = compress(data, encoding)
+        if len(compressed) >= len(data):
+            continue
+        with open(path + EXTENSIONS[encoding], 'wb') as f:
+            f.write(compressed)
+        written.append(path + EXTENSIONS[encoding])
+    return written
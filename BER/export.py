@@ -0,0 +1,145 @@
+import json
+import logging
+import os
+import posixpath
+import re
+
+from jinja2 import TemplateNotFound, meta
+
+import tornado.gen
+import tornado.httpclient
+import tornado.httpserver
+import tornado.netutil
+
+from .compression import precompress
+from .mitte import Engine, template_name
+
+
+log = logging.getLogger(__name__)
+
+MANIFEST = 'export.json'
+URL_PATH = re.compile(r'/[a-z0-9\-_\/\.]*')
+REQUEST_GLOBALS = frozenset((
+    'arguments', 'host', 'remote_ip', 'path', 'uri', 'method', 'protocol'))
+
+
+def exportable(site, slug):
+    """ Whether the page at `slug` renders the same for every request: a
+    literal route without data sources, redirects or a response cache
+    varying on the request. """
+
+    page = site['pages'][slug]
+    if not isinstance(page, dict) or page.get('export') is False:
+        return False
+    if 'data_sources' in page or 'redirect' in page:
+        return False
+    if page.get('published') is False:
+        return False
+    if page.get('response_cache', {}).get('vary'):
+        return False
+
+    # the pattern has to be a path itself, and the route serving it
+    if not URL_PATH.fullmatch(slug):
+        return False
+    result = site['routes'].match(slug)
+    return result is not None and result[0].pattern == slug and \
+        not result[0].groups
+
+
+def uses_request_globals(env, loader, tpl_name, seen=None):
+    """ Whether the template, or one it extends, includes or imports, reads
+    a global that differs between requests. Templates named dynamically
+    can't be followed and count as reading them. """
+
+    seen = set() if seen is None else seen
+    seen.add(tpl_name)
+
+    source, _, _ = loader.get_source(env, tpl_name)
+    ast = env.parse(source)
+    if meta.find_undeclared_variables(ast) & REQUEST_GLOBALS:
+        return True
+    for name in meta.find_referenced_templates(ast):
+        if name is None:
+            return True
+        if name not in seen and uses_request_globals(env, loader, name, seen):
+            return True
+    return False
+
+
+def export_name(slug):
+    if slug.endswith('/'):
+        return slug[1:] + 'index.html'
+    if posixpath.splitext(slug)[1]:
+        return slug[1:]
+    return slug[1:] + '.html'
+
+
+def load_export(path):
+    try:
+        with open(os.path.join(path, MANIFEST)) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+
+@tornado.gen.coroutine
+def export_site(app, target, host, protocol='https'):
+    """ Render every exportable page through `app` for `host` and write it
+    to `target` with precompressed variants and a manifest of the exported
+    routes. Pages whose templates read request globals are rendered per
+    request instead. """
+
+    engine = Engine.for_application(app)
+
+    sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+    port = sockets[0].getsockname()[1]
+    server = tornado.httpserver.HTTPServer(app, xheaders=True)
+    server.add_sockets(sockets)
+    client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+
+    site = app.settings['site']
+    manifest = {}
+    try:
+        for slug in site['pages']:
+            if not exportable(site, slug):
+                continue
+
+            tpl_name = site['pages'][slug].get('tpl_name', template_name(slug))
+            try:
+                if uses_request_globals(engine.template_env,
+                                        engine.filesystem_loader, tpl_name):
+                    log.info('not exporting %s, its template reads request '
+                             'globals', slug)
+                    continue
+            except TemplateNotFound:
+                log.warning('not exporting %s, template %s not found',
+                            slug, tpl_name)
+                continue
+
+            response = yield client.fetch(
+                f'http://127.0.0.1:{port}{slug}',
+                headers={'Host': host, 'X-Forwarded-Proto': protocol},
+                follow_redirects=False, raise_error=False)
+            if response.code != 200:
+                log.warning('not exporting %s, it responded with %d',
+                            slug, response.code)
+                continue
+
+            name = export_name(slug)
+            path = os.path.join(target, *name.split('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(response.body)
+            precompress(path)
+
+            manifest[slug] = {
+                'file': name,
+                'content_type': response.headers['Content-Type']}
+    finally:
+        client.close()
+        server.stop()
+
+    with open(os.path.join(target, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
@@ -0,0 +1,47 @@
+import os
+
+from prometheus_client import CollectorRegistry, REGISTRY, multiprocess
+
+
+OVERFLOW = '__overflow__'
+
+
+def multiprocess_dir():
+    return (os.environ.get('PROMETHEUS_MULTIPROC_DIR') or
+            os.environ.get('prometheus_multiproc_dir'))
+
+
+def get_registry():
+    if not multiprocess_dir():
+        return REGISTRY
+    # aggregate the values all worker processes wrote
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+class LabelLimiter(object):
+    """ Passes through the first `max_values` label values it sees and maps
+    every later one to a shared overflow value. """
+
+    def __init__(self, max_values=1000):
+        self.max_values = max_values
+        self.values = set()
+
+    def __call__(self, value):
+        if value in self.values:
+            return value
+        if len(self.values) >= self.max_values:
+            return OVERFLOW
+        self.values.add(value)
+        return value
+
+
+def status_class(status_code):
+    return f'{status_code // 100}xx'
+
+
+def method_label(method, supported_methods):
+    """ Methods a handler doesn't support all share the overflow label, so
+    made up ones don't each add a series. """
+    return method if method in supported_methods else OVERFLOW
@@ -1,24 +1,36 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import hashlib
 import json
+import logging
 import os
+import zipfile
+from datetime import timedelta
+from functools import partial
 from time import strftime, time
 
 import feedparser
 
-from jinja2 import (Environment as JinjaEnvironment,
+from jinja2 import (ChoiceLoader,
+                    Environment as JinjaEnvironment,
                     FileSystemBytecodeCache,
                     FileSystemLoader,
-                    Markup)
+                    Markup,
+                    ModuleLoader,
+                    TemplateNotFound,
+                    TemplateSyntaxError)
+from jinja2.loaders import split_template_path
 
 import misaka
 
-from prometheus_client import Summary
+from prometheus_client import Counter, Summary
 
 import tornado.gen
 import tornado.httpclient
 import tornado.httpserver
+import tornado.locks
+import tornado.util
 import tornado.web
 
 from webassets import Environment as AssetsEnvironment
@@ -28,67 +40,445 @@ from webassets.filter.libsass import LibSass
 
 import yaml
 
+from .assets import MANIFEST, load_manifest
+from .cache import (DataCache,
+                    LocalDataCache,
+                    LRUCache,
+                    ResponseCache,
+                    stat_key)
+from .compression import accepted_encodings
+from .metrics import LabelLimiter
+from .pool import DataExecutor
+from .projection import Projection, load_json, truncate_feed
+from .timing import RequestTimer, null_phase
+from .upstream import CircuitOpenError, UpstreamClient
 
-class EngineMixin(object):
-    get_data_time = Summary('get_data_time',
-                            'Time spent getting data.',
-                            ['src', 'format'])
 
-    def initialize(self):
-        loader = FileSystemLoader([
-            self.settings['template_path'],
-            self.settings['snippet_path']])
+log = logging.getLogger(__name__)
+
+register_filter(LibSass)
+
+CHECKSUMS = 'checksums.json'
+
+
+def read_file(path):
+    with open(path) as f:
+        return f.read()
+
+
+def read_file_stat(path):
+    # stat before reading, a change in between shows up on the next stat
+    stat = stat_key(path)
+    return read_file(path), stat
+
+
+def parse_data(format, data, projection=None):
+    if projection is not None:
+        return parse_projected(format, data, projection)
+
+    if format == 'json':
+        parsed_data = json.loads(data)
+    elif format == 'yaml':
+        parsed_data = yaml.safe_load(data)
+    elif format == 'rss':
+        parsed_data = feedparser.parse(data)
+    return parsed_data
+
+
+def parse_projected(format, data, projection):
+    """ Parse only as much of `data` as `projection` needs, where the format
+    allows stopping early, and keep only the projected items. """
+
+    if format == 'json':
+        return load_json(data, projection)
+
+    if format == 'rss':
+        if projection.limit is not None:
+            data = truncate_feed(data, projection.limit)
+        parsed_data = feedparser.parse(data)
+        parsed_data['entries'] = projection.apply(parsed_data['entries'])
+        return parsed_data
+
+    parsed_data = parse_data(format, data)
+    if isinstance(parsed_data, list):
+        return projection.apply(parsed_data)
+    return parsed_data
+
+
+def template_name(slug):
+    """ The template rendering `slug` unless its page sets tpl_name. """
+    if slug.endswith('/'):
+        return slug + 'index.html'
+    return slug + '.html'
+
+
+def template_checksum(source):
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+class BundleLoader(ModuleLoader):
+    """ Loads templates precompiled by compile_templates. Names are
+    normalized like FileSystemLoader does, so `/index.html` and
+    `index.html` find the same template.
+
+    A template whose source in `sources` changed since it was compiled
+    isn't found, so a ChoiceLoader falls back to the source. """
+
+    def __init__(self, path, sources):
+        super(BundleLoader, self).__init__(path)
+        self.sources = sources
+        with zipfile.ZipFile(path) as bundle:
+            try:
+                self.checksums = json.loads(bundle.read(CHECKSUMS))
+            except KeyError:
+                self.checksums = {}
+
+    @staticmethod
+    def get_template_key(name):
+        name = '/'.join(split_template_path(name))
+        return ModuleLoader.get_template_key(name)
+
+    def load(self, environment, name, globals=None):
+        try:
+            source, _, _ = self.sources.get_source(environment, name)
+        except TemplateNotFound:
+            # deployed without the sources
+            pass
+        else:
+            key = '/'.join(split_template_path(name))
+            if self.checksums.get(key) != template_checksum(source):
+                raise TemplateNotFound(name)
+        return super(BundleLoader, self).load(environment, name, globals)
+
+
+class Engine(object):
+    markdown_lookup_total = Counter(
+        'markdown_cache_lookup_total',
+        'Rendered markdown cache lookups.',
+        ['result'])
+
+    def __init__(self, settings):
+        self.settings = settings
+
+        self.filesystem_loader = FileSystemLoader([
+            settings['template_path'],
+            settings['snippet_path']])
+        loader = self.filesystem_loader
+
+        bundle = settings.get('template_bundle')
+        if bundle and os.path.exists(bundle):
+            # prefer the precompiled templates, fall back to the sources
+            # for templates added or changed after the bundle was compiled
+            loader = ChoiceLoader([BundleLoader(bundle, loader), loader])
+
         assets_env = AssetsEnvironment(
-            self.settings['static_path'], self.static_url(''))
-        register_filter(LibSass)
+            settings['static_path'], self.static_url('', False))
 
         self.template_env = JinjaEnvironment(
             loader=loader,
             extensions=[AssetsExtension],
-            bytecode_cache=FileSystemBytecodeCache())
+            bytecode_cache=FileSystemBytecodeCache(
+                settings.get('bytecode_cache_path')))
 
         self.template_env.assets_environment = assets_env
 
+        self.manifest = load_manifest(settings.get(
+            'asset_manifest',
+            os.path.join(settings['static_path'], MANIFEST)))
+        if self.manifest is not None:
+            # bundles were built ahead of time, don't check them per request
+            assets_env.auto_build = False
+            assets_env.url_expire = False
+            assets_env.versions = False
+
         self.template_env.filters['stylesheet_tag'] = self.stylesheet_tag
         self.template_env.filters['javascript_tag'] = self.javascript_tag
         self.template_env.filters['theme_image_url'] = self.theme_image_url
         self.template_env.filters['strftime'] = self.strftime
         self.template_env.filters['markdown'] = self.markdown
 
-        self.template_env.globals.update(self.get_globals())
-
-        self.site = self.settings['site']
-        self.client = tornado.httpclient.AsyncHTTPClient()
+        self.markdown_renderer = misaka.Markdown(
+            misaka.HtmlRenderer(),
+            extensions=('fenced-code',))
+        self.markdown_cache = LRUCache(
+            settings.get('markdown_cache_max_entries', 1024))
+
+        self.data_caches = {}
+        self.upstream = UpstreamClient(**settings.get('upstream', {}))
+        self._executor = None
+        self._local_data_cache = None
+        self.response_cache = ResponseCache(
+            settings.get('response_cache_max_entries', 1024))
+
+    @classmethod
+    def for_application(cls, application):
+        engine = getattr(application, 'engine', None)
+        if engine is None:
+            engine = application.engine = cls(application.settings)
+        return engine
+
+    def static_url(self, path, include_version=True):
+        static_handler_class = self.settings.get(
+            'static_handler_class', tornado.web.StaticFileHandler)
+        return static_handler_class.make_static_url(
+            self.settings, path, include_version)
+
+    def asset_url(self, name):
+        if name.startswith('http'):
+            return name
+        if self.manifest is not None and name in self.manifest:
+            # prebuilt and fingerprinted, no need to hash the file
+            return self.static_url(self.manifest[name], False)
+        return self.static_url(name)
 
     def stylesheet_tag(self, name):
-        href = name
-        if not name.startswith('http'):
-            href = self.static_url(name)
+        href = self.asset_url(name)
         return ('<link type="text/css"'
                 ' rel="stylesheet"'
                 ' media="screen"'
                 ' href="{0}">'.format(href))
 
     def javascript_tag(self, name):
-        src = name
-        if not name.startswith('http'):
-            src = self.static_url(name)
+        src = self.asset_url(name)
         return '<script type="text/javascript" src="{0}"></script>'.format(src)
 
     def theme_image_url(self, name):
-        src = name
-        if not name.startswith('http'):
-            src = self.static_url(name)
+        src = self.asset_url(name)
         return '{0}'.format(src)
 
     def strftime(self, time_struct, format):
         return strftime(format, time_struct)
 
     def markdown(self, text):
-        md = misaka.Markdown(
-            misaka.HtmlRenderer(),
-            extensions=('fenced-code',))
-        return Markup(md(text))
+        key = hashlib.sha1(text.encode('utf-8')).digest()
+        html = self.markdown_cache.get(key)
+        if html is None:
+            self.markdown_lookup_total.labels('miss').inc()
+            html = Markup(self.markdown_renderer(text))
+            self.markdown_cache.set(key, html)
+        else:
+            self.markdown_lookup_total.labels('hit').inc()
+        return html
+
+    def get_template(self, tpl_name):
+        return self.template_env.get_template(tpl_name)
+
+    def compile_templates(self, target):
+        """ Compile all template sources into the zip file `target`, to be
+        loaded through the template_bundle setting. """
+        env = self.template_env.overlay(loader=self.filesystem_loader)
+        env.compile_templates(
+            target, log_function=log.debug, ignore_errors=False)
+
+        checksums = {}
+        for tpl_name in env.list_templates():
+            source, _, _ = self.filesystem_loader.get_source(env, tpl_name)
+            checksums[tpl_name] = template_checksum(source)
+        with zipfile.ZipFile(target, 'a') as bundle:
+            bundle.writestr(CHECKSUMS, json.dumps(checksums))
+        return len(checksums)
+
+    def warmup(self):
+        """ Load and compile every template, so the first requests don't
+        have to. """
+        templates = 0
+        for tpl_name in self.filesystem_loader.list_templates():
+            try:
+                self.get_template(tpl_name)
+            except (TemplateSyntaxError, UnicodeDecodeError):
+                log.warning('could not compile template %s', tpl_name,
+                            exc_info=True)
+            else:
+                templates += 1
+        return templates
+
+    @staticmethod
+    def data_cache_key(source):
+        # sources sharing a src with different settings get a cache each,
+        # instead of replacing each other's
+        config = tuple(sorted(source['cache'].items()))
+        return source['src'], source['format'], config
+
+    def get_data_cache(self, source):
+        key = self.data_cache_key(source)
+        cache = self.data_caches.get(key)
+        if cache is None:
+            cache = self.data_caches[key] = DataCache(**source['cache'])
+        return cache
+
+    def prune_data_caches(self, site):
+        """ Drop the caches, and the data in them, of sources `site` no
+        longer has. """
+
+        keys = set()
+        for page in site['pages'].values():
+            if not isinstance(page, dict):
+                continue
+            for source in page.get('data_sources', {}).values():
+                if 'cache' in source:
+                    keys.add(self.data_cache_key(source))
+
+        for key in set(self.data_caches) - keys:
+            del self.data_caches[key]
+
+    @property
+    def executor(self):
+        # created on first use, so process pools are only started in the
+        # process serving requests
+        if self._executor is None:
+            self._executor = DataExecutor(
+                self.settings.get('data_executor', 'thread'),
+                self.settings.get('data_executor_workers', 4))
+        return self._executor
+
+    @property
+    def local_data_cache(self):
+        if self._local_data_cache is None:
+            self._local_data_cache = LocalDataCache(
+                self.settings.get(
+                    'local_data_cache_max_size', 64 * 1024 * 1024))
+            interval = self.settings.get('local_data_watch_interval')
+            if interval:
+                self._local_data_cache.watch(interval)
+        return self._local_data_cache
+
+    @tornado.gen.coroutine
+    def get_data_local_parsed(self, src, format, phase=null_phase,
+                              projection=None):
+        path = os.path.join(self.settings['data_path'], src)
+        cache = self.local_data_cache
+
+        stat = None
+        if not cache.watching:
+            try:
+                stat = stat_key(path)
+            except OSError:
+                raise tornado.web.HTTPError(404)
+
+        entry = cache.get(path, format, stat, projection)
+        if entry is not None:
+            return entry.value
+
+        try:
+            with phase('fetch'):
+                data, stat = yield self.executor.submit(read_file_stat, path)
+        except IOError:
+            raise tornado.web.HTTPError(404)
+
+        with phase('parse'):
+            parsed_data = yield self.parse(format, data, projection)
+        cache.set(path, format, stat, parsed_data, projection)
+        return parsed_data
+
+    def parse_data(self, format, data, projection=None):
+        return parse_data(format, data, projection)
+
+    @tornado.gen.coroutine
+    def parse(self, format, data, projection=None):
+        threshold = self.settings.get('parse_offload_threshold', 64 * 1024)
+        if len(data) < threshold:
+            return self.parse_data(format, data, projection)
+        parsed_data = yield self.executor.submit(
+            parse_data, format, data, projection)
+        return parsed_data
+
+    @tornado.gen.coroutine
+    def get_data_remote_parsed(self, src, format, previous=None,
+                               phase=null_phase, projection=None):
+        headers = {}
+        if previous is not None:
+            if 'etag' in previous.validators:
+                headers['If-None-Match'] = previous.validators['etag']
+            if 'last_modified' in previous.validators:
+                headers['If-Modified-Since'] = \
+                    previous.validators['last_modified']
+
+        request = tornado.httpclient.HTTPRequest(src, headers=headers)
+        try:
+            with phase('fetch'):
+                response = yield self.upstream.fetch(request)
+        except tornado.httpclient.HTTPClientError as e:
+            if e.code == 304 and previous is not None:
+                # unchanged upstream, reuse the already parsed data
+                return previous.value, previous.validators
+            raise tornado.web.HTTPError(e.code)
+        except CircuitOpenError:
+            raise tornado.web.HTTPError(503)
+
+        validators = {}
+        if 'ETag' in response.headers:
+            validators['etag'] = response.headers['ETag']
+        if 'Last-Modified' in response.headers:
+            validators['last_modified'] = response.headers['Last-Modified']
+
+        with phase('parse'):
+            parsed_data = yield self.parse(
+                format, response.body, projection)
+        return parsed_data, validators
+
+    @tornado.gen.coroutine
+    def load_data(self, source, src, phase=null_phase):
+        """ Load and parse the data of `source` from `src`, recording the
+        fetch and parse phases with `phase`. """
+
+        format = source['format']
+        projection = Projection.from_source(source)
+
+        if not src.startswith('http'):
+            parsed_data = yield self.get_data_local_parsed(
+                src, format, phase=phase, projection=projection)
+            return parsed_data
+
+        if 'cache' not in source:
+            parsed_data, _ = yield self.get_data_remote_parsed(
+                src, format, phase=phase, projection=projection)
+            return parsed_data
+
+        # a miss is shared with concurrent requests, time it as one fetch
+        cache = self.get_data_cache(source)
+        with phase('fetch'):
+            parsed_data = yield cache.get(
+                (src, format, projection),
+                partial(self.get_data_remote_parsed, src, format,
+                        projection=projection))
+        return parsed_data
+
+    @tornado.gen.coroutine
+    def prefetch(self, source):
+        """ Refresh the cached data of a non-templated `source` ahead of
+        the requests reading it, whether or not it expired. """
+
+        src = source['src']
+        format = source['format']
+        projection = Projection.from_source(source)
+
+        if not src.startswith('http'):
+            # only read again if the file changed
+            yield self.get_data_local_parsed(
+                src, format, projection=projection)
+        elif 'cache' in source:
+            cache = self.get_data_cache(source)
+            yield cache.load(
+                (src, format, projection),
+                partial(self.get_data_remote_parsed, src, format,
+                        projection=projection))
+
+
+class EngineMixin(object):
+    get_data_time = Summary('get_data_time',
+                            'Time spent getting data.',
+                            ['source', 'format'])
+    source_label = LabelLimiter()
+
+    def initialize(self):
+        self.engine = Engine.for_application(self.application)
+        self.template_env = self.engine.template_env
+
+        self.site = self.settings['site']
+        self.timer = RequestTimer()
+
+        # per request, so sources resolving to the same src are loaded once
+        self.data_context = {}
 
     def get_globals(self):
         globals = {
@@ -102,76 +492,137 @@ class EngineMixin(object):
             'protocol': self.request.protocol}
         return globals
 
-    @tornado.gen.coroutine
-    def get_data_remote(self, src):
-        request = tornado.httpclient.HTTPRequest(src)
-        try:
-            response = yield self.client.fetch(request)
-        except tornado.httpclient.HTTPClientError as e:
-            raise tornado.web.HTTPError(e.code)
-        return response.body
+    def render_template(self, template, **kwargs):
+        return template.render(self.get_globals(), **kwargs)
 
     @tornado.gen.coroutine
-    def get_data_local(self, src):
-        path = os.path.join(self.settings['data_path'], src)
-        try:
-            with open(path) as f:
-                return f.read()
-        except IOError:
-            raise tornado.web.HTTPError(404)
-
-    def parse_data(self, format, data):
-        if format == 'json':
-            parsed_data = json.loads(data)
-        elif format == 'yaml':
-            parsed_data = yaml.safe_load(data)
-        elif format == 'rss':
-            parsed_data = feedparser.parse(data)
-        return parsed_data
+    def stream_template(self, template, **kwargs):
+        buffer_size = self.settings.get('stream_buffer_size', 16 * 1024)
+        buffered = 0
+        for chunk in template.generate(self.get_globals(), **kwargs):
+            self.write(chunk)
+            buffered += len(chunk)
+            if buffered >= buffer_size:
+                yield self.flush()
+                buffered = 0
+        self.finish()
+
+    def get_response_cache_key(self, slug, page):
+        key = [slug]
+        for dimension in page['response_cache'].get('vary', []):
+            value = getattr(self.request, dimension)
+            if dimension == 'arguments':
+                value = tuple(sorted(
+                    (k, tuple(v)) for k, v in value.items()))
+            key.append((dimension, value))
+        return tuple(key)
+
+    def write_cached_response(self, entry):
+        encodings = accepted_encodings(
+            self.request.headers.get('Accept-Encoding'))
+        encoding, body, etag = entry.get_variant(encodings)
+
+        for name, value in entry.headers.items():
+            self.set_header(name, value)
+        if not self.settings.get('compress_response'):
+            # otherwise added by tornado's gzip transform
+            self.set_header('Vary', 'Accept-Encoding')
+        if encoding is not None:
+            self.set_header('Content-Encoding', encoding)
+        self.set_header('Etag', etag)
+
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+        else:
+            self.finish(body)
 
     @tornado.gen.coroutine
-    def get_data(self, source, named_groups=None):
+    def get_data(self, source, named_groups=None, name=None):
         start_time = time()
-        data = None
         src = source['src']
         format = source['format']
 
         if named_groups:
             src = src.format(**named_groups)
 
-        if src.startswith('http'):
-            data = yield self.get_data_remote(src)
-        else:
-            data = yield self.get_data_local(src)
-
-        parsed_data = self.parse_data(format, data)
+        key = (src, format, Projection.from_source(source))
+        future = self.data_context.get(key)
+        if future is None:
+            future = self.data_context[key] = self.engine.load_data(
+                source, src, phase=partial(self.timer.phase, description=name))
+        parsed_data = yield future
 
         time_delta = time() - start_time
-        self.get_data_time.labels(src, format).observe(time_delta)
+        # label by name, interpolated srcs would grow without bound
+        label = self.source_label(name or source['src'])
+        self.get_data_time.labels(label, format).observe(time_delta)
 
         return parsed_data
 
-    def get_page(self, slug):
-        routes = self.site['routes']
-        pages = self.site['pages']
+    @tornado.gen.coroutine
+    def get_data_source(self, source, semaphore, named_groups=None,
+                        name=None):
+        yield semaphore.acquire()
+        future = self.get_data(source, named_groups=named_groups, name=name)
+        # a timeout doesn't cancel the fetch, keep its slot until it is done
+        # so the limit applies to fetches in flight
+        future.add_done_callback(lambda f: semaphore.release())
+
+        if 'timeout' not in source:
+            data = yield future
+            return data
+
+        try:
+            data = yield tornado.gen.with_timeout(
+                timedelta(seconds=source['timeout']), future,
+                quiet_exceptions=tornado.web.HTTPError)
+        except tornado.util.TimeoutError:
+            raise tornado.web.HTTPError(504)
+        return data
 
-        for route in routes:
-            match = route.fullmatch(slug)
-            if match:
-                named_groups = {
-                    k: match.groups()[v-1]
-                    for k, v in route.groupindex.items()}
-                return route.pattern, pages[route.pattern], named_groups
+    @tornado.gen.coroutine
+    def get_data_sources(self, page, named_groups=None):
+        sources = page['data_sources']
+        concurrency = page.get('data_sources_concurrency') or len(sources)
+        semaphore = tornado.locks.Semaphore(concurrency)
+
+        @tornado.gen.coroutine
+        def get_result(name):
+            try:
+                data = yield self.get_data_source(
+                    sources[name], semaphore, named_groups=named_groups,
+                    name=name)
+            except Exception as e:
+                return None, e
+            return data, None
+
+        results = yield {name: get_result(name) for name in sources}
+
+        # raise the first failure in the order the sources are declared in,
+        # not the order they completed in
+        data_sources = {}
+        for name in sources:
+            data, error = results[name]
+            if error is not None:
+                raise error
+            data_sources[name] = data
+
+        return data_sources
 
-        raise tornado.web.HTTPError(404)
+    def get_page(self, slug):
+        result = self.site['routes'].match(slug)
+        if result is None:
+            raise tornado.web.HTTPError(404)
+
+        route, match = result
+        named_groups = {
+            k: match.groups()[v-1]
+            for k, v in route.groupindex.items()}
+        return route.pattern, self.site['pages'][route.pattern], named_groups
 
     def get_template_by_slug(self, slug):
-        tpl_name = slug
-        if slug.endswith('/'):
-            tpl_name += 'index.html'
-        else:
-            tpl_name += '.html'
-        return self.get_template(tpl_name)
+        return self.get_template(template_name(slug))
 
     def get_template(self, tpl_name):
-        return self.template_env.get_template(tpl_name)
+        return self.engine.get_template(tpl_name)
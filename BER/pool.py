@@ -0,0 +1,55 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from time import time
+
+from prometheus_client import Gauge, Summary
+
+import tornado.gen
+import tornado.ioloop
+
+
+def timed(fn, *args):
+    start_time = time()
+    result = fn(*args)
+    return result, start_time, time() - start_time
+
+
+class DataExecutor(object):
+    pending = Gauge(
+        'data_executor_pending',
+        'Tasks queued or running in the data executor.',
+        multiprocess_mode='livesum')
+    wait_time = Summary(
+        'data_executor_wait_seconds',
+        'Time tasks spent queued for the data executor.',
+        ['task'])
+    execution_time = Summary(
+        'data_executor_execution_seconds',
+        'Time tasks spent executing in the data executor.',
+        ['task'])
+
+    executor_classes = {
+        'thread': ThreadPoolExecutor,
+        'process': ProcessPoolExecutor}
+
+    def __init__(self, kind='thread', max_workers=4):
+        self.executor = self.executor_classes[kind](max_workers)
+
+    @tornado.gen.coroutine
+    def submit(self, fn, *args):
+        # fn and args have to be picklable for process executors
+        loop = tornado.ioloop.IOLoop.current()
+        submitted = time()
+        self.pending.inc()
+        try:
+            result, start_time, time_delta = yield loop.run_in_executor(
+                self.executor, timed, fn, *args)
+        finally:
+            self.pending.dec()
+
+        self.wait_time.labels(fn.__name__).observe(
+            max(start_time - submitted, 0))
+        self.execution_time.labels(fn.__name__).observe(time_delta)
+        return result
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait)
@@ -0,0 +1,118 @@
+import logging
+import random
+from time import time
+
+from prometheus_client import Counter, Gauge, Summary
+
+import tornado.gen
+import tornado.ioloop
+import tornado.locks
+
+from .metrics import LabelLimiter
+from .mitte import Engine
+from .projection import Projection
+
+
+log = logging.getLogger(__name__)
+
+
+class Prefetcher(object):
+    """ Refreshes the data sources declared with a `refresh_interval` in the
+    background, so requests find their data cached. Sources with a templated
+    `src` can't be known ahead of a request, remote sources without a
+    `cache` have nothing to keep warm, both are left out.
+
+    Refreshes are spread by up to `jitter` of their interval, at most
+    `concurrency` run at a time. """
+
+    prefetch_total = Counter(
+        'data_prefetch_total', 'Background data source refreshes.',
+        ['source', 'result'])
+    prefetch_time = Summary(
+        'data_prefetch_seconds',
+        'Time spent refreshing data sources in the background.',
+        ['source'])
+    last_success = Gauge(
+        'data_prefetch_last_success_timestamp_seconds',
+        'Time of the last successful background refresh of a data source.',
+        ['source'], multiprocess_mode='max')
+    source_label = LabelLimiter()
+
+    def __init__(self, application, concurrency=4, jitter=0.1, resolution=1):
+        self.application = application
+        self.engine = Engine.for_application(application)
+        self.semaphore = tornado.locks.Semaphore(concurrency)
+        self.jitter = jitter
+        self.resolution = resolution
+        self.next_run = {}
+        self.running = set()
+        self.watcher = None
+
+    def sources(self):
+        # read on every check, the site may have been reloaded
+        sources = {}
+        for page in self.application.settings['site']['pages'].values():
+            if not isinstance(page, dict):
+                continue
+            for source in page.get('data_sources', {}).values():
+                if 'refresh_interval' not in source or '{' in source['src']:
+                    continue
+                if source['src'].startswith('http') and 'cache' not in source:
+                    continue
+                key = (source['src'], source['format'],
+                       Projection.from_source(source))
+                sources[key] = source
+        return sources
+
+    def check(self):
+        now = time()
+        sources = self.sources()
+
+        for key in list(self.next_run):
+            if key not in sources:
+                del self.next_run[key]
+
+        for key, source in sources.items():
+            interval = source['refresh_interval']
+            if key not in self.next_run:
+                # warm up soon after starting, but not all at once
+                self.next_run[key] = now + random.uniform(
+                    0, self.jitter * interval)
+            if now < self.next_run[key] or key in self.running:
+                continue
+
+            self.next_run[key] = now + interval * random.uniform(
+                1 - self.jitter, 1 + self.jitter)
+            self.running.add(key)
+            tornado.ioloop.IOLoop.current().spawn_callback(
+                self.refresh, key, source)
+
+    @tornado.gen.coroutine
+    def refresh(self, key, source):
+        label = self.source_label(source['src'])
+        try:
+            with (yield self.semaphore.acquire()):
+                start_time = time()
+                try:
+                    yield self.engine.prefetch(source)
+                except Exception:
+                    self.prefetch_total.labels(label, 'failure').inc()
+                    log.warning('prefetching %s failed', source['src'],
+                                exc_info=True)
+                else:
+                    self.prefetch_total.labels(label, 'success').inc()
+                    self.last_success.labels(label).set_to_current_time()
+                self.prefetch_time.labels(label).observe(time() - start_time)
+        finally:
+            self.running.discard(key)
+
+    def start(self):
+        self.watcher = tornado.ioloop.PeriodicCallback(
+            self.check, self.resolution * 1000)
+        self.watcher.start()
+        tornado.ioloop.IOLoop.current().add_callback(self.check)
+
+    def stop(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
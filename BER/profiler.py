@@ -0,0 +1,117 @@
+import sys
+import threading
+from collections import Counter
+from time import perf_counter
+
+import tornado.gen
+import tornado.ioloop
+
+
+# shorter intervals would keep the sampling thread busy holding the GIL
+MIN_INTERVAL = 0.001
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f'{frame.f_globals.get("__name__", "?")}:{code.co_name}'
+
+
+def collapse(frame):
+    """ The stack of `frame` in collapsed form, outermost call first. """
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler(object):
+    """ Samples the stacks of all threads every `interval` seconds from a
+    background thread, so the profiled code isn't instrumented.
+
+    It also checks the IOLoop it was started on: a heartbeat is scheduled on
+    it every `interval`, and if one is late by more than `threshold` the
+    loop's stack at that moment is recorded as a blocking call. """
+
+    def __init__(self, interval=0.005, threshold=0.1):
+        self.interval = interval
+        self.threshold = threshold
+        self.stacks = Counter()
+        self.blocking = []
+        self.samples = 0
+
+        self.thread = None
+        self.stopped = threading.Event()
+        self.loop = None
+        self.loop_thread_id = None
+        self.last_beat = None
+        self.blocked_stack = None
+
+    def sample(self):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        frames = sys._current_frames()
+        for thread_id, frame in frames.items():
+            if thread_id == self.thread.ident:
+                continue
+            thread_name = names.get(thread_id, str(thread_id))
+            self.stacks[f'{thread_name};{collapse(frame)}'] += 1
+        self.samples += 1
+
+        late = perf_counter() - self.last_beat - self.interval
+        if late > self.threshold and self.blocked_stack is None:
+            frame = frames.get(self.loop_thread_id)
+            if frame is not None:
+                self.blocked_stack = collapse(frame)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def heartbeat(self):
+        now = perf_counter()
+        late = now - self.last_beat - self.interval
+        if late > self.threshold:
+            self.blocking.append({
+                'seconds': late,
+                'stack': self.blocked_stack})
+        self.blocked_stack = None
+        self.last_beat = now
+
+        if not self.stopped.is_set():
+            self.loop.call_later(self.interval, self.heartbeat)
+
+    def start(self):
+        self.loop = tornado.ioloop.IOLoop.current()
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = perf_counter()
+        self.loop.call_later(self.interval, self.heartbeat)
+
+        self.thread = threading.Thread(
+            target=self.run, name='profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    @tornado.gen.coroutine
+    def profile(self, seconds):
+        self.start()
+        try:
+            yield tornado.gen.sleep(seconds)
+        finally:
+            self.stop()
+
+    def collapsed(self):
+        """ Flamegraph-ready output, one `stack count` line per stack. """
+        return ''.join(f'{stack} {count}\n'
+                       for stack, count in self.stacks.most_common())
+
+    def to_dict(self):
+        return {
+            'interval': self.interval,
+            'threshold': self.threshold,
+            'samples': self.samples,
+            'stacks': dict(self.stacks.most_common()),
+            'blocking': sorted(self.blocking,
+                               key=lambda b: b['seconds'], reverse=True)}
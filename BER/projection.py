@@ -0,0 +1,100 @@
+import json
+import re
+from collections import namedtuple
+
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+FEED_ITEM_END = re.compile(r'</(?:[\w.-]+:)?(?:item|entry)\s*>', re.I)
+FEED_ITEM_END_BYTES = re.compile(rb'</(?:[\w.-]+:)?(?:item|entry)\s*>', re.I)
+
+decoder = json.JSONDecoder()
+
+
+class Projection(namedtuple('Projection', ['limit', 'fields'])):
+    """ The part of a data source's items a site uses: the first `limit`
+    items, with only the keys in `fields`. Items are the top-level list of
+    json and yaml data and the entries of rss feeds. """
+
+    @classmethod
+    def from_source(cls, source):
+        if 'limit' not in source and 'fields' not in source:
+            return None
+        fields = source.get('fields')
+        return cls(source.get('limit'),
+                   tuple(fields) if fields is not None else None)
+
+    def project_item(self, item):
+        if self.fields is None or not isinstance(item, dict):
+            return item
+        return {k: item[k] for k in self.fields if k in item}
+
+    def apply(self, items):
+        if self.limit is not None:
+            items = items[:self.limit]
+        if self.fields is not None:
+            items = [self.project_item(item) for item in items]
+        return items
+
+
+def iter_json_array(data, index=0):
+    """ Decode the items of the json array whose `[` is at `index` one at a
+    time, so decoding can stop before the end of the document. """
+
+    index = WHITESPACE.match(data, index + 1).end()
+    if data[index:index + 1] == ']':
+        return
+
+    while True:
+        item, index = decoder.raw_decode(data, index)
+        yield item
+        index = WHITESPACE.match(data, index).end()
+        separator = data[index:index + 1]
+        if separator == ']':
+            return
+        if separator != ',':
+            raise json.JSONDecodeError(
+                'Expecting \',\' delimiter', data, index)
+        index = WHITESPACE.match(data, index + 1).end()
+
+
+def load_json(data, projection):
+    if isinstance(data, bytes):
+        data = data.decode(json.detect_encoding(data))
+
+    index = WHITESPACE.match(data).end()
+    if projection.limit is None or data[index:index + 1] != '[':
+        parsed = json.loads(data)
+        if isinstance(parsed, list):
+            return projection.apply(parsed)
+        return parsed
+
+    items = []
+    for item in iter_json_array(data, index):
+        items.append(projection.project_item(item))
+        if len(items) >= projection.limit:
+            break
+    return items
+
+
+def truncate_feed(data, limit):
+    """ Cut the items after the first `limit` out of an rss or atom feed,
+    keeping whatever follows the last item, like the closing tags. """
+
+    pattern = FEED_ITEM_END_BYTES if isinstance(data, bytes) \
+        else FEED_ITEM_END
+
+    ends = pattern.finditer(data)
+    cut = None
+    for count, match in enumerate(ends, 1):
+        if count == limit:
+            cut = match.end()
+            break
+    if cut is None:
+        return data
+
+    last = None
+    for last in ends:
+        pass
+    if last is None:
+        return data
+    return data[:cut] + data[last.end():]
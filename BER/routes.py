@@ -0,0 +1,108 @@
+from re import compile, search
+
+
+METACHARACTERS = '.^$*+?{}[]|()'
+QUANTIFIERS = '*?{'
+
+
+def literal_prefix(pattern):
+    """ Return the literal prefix every match of `pattern` starts with and
+    whether the pattern is a literal as a whole. """
+
+    # alternations and inline flags can change what the prefix matches
+    if '|' in pattern or search(r'\(\?[aiLmsux]', pattern):
+        return '', False
+
+    prefix = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        step = 1
+        if char == '\\':
+            char = pattern[i + 1:i + 2]
+            if not char or char.isalnum():
+                break
+            step = 2
+        elif char in METACHARACTERS:
+            break
+
+        following = pattern[i + step:i + step + 1]
+        if following and following in QUANTIFIERS:
+            # the char may not be there at all
+            break
+
+        prefix.append(char)
+        i += step
+
+        if following == '+':
+            break
+
+    return ''.join(prefix), i == len(pattern)
+
+
+class RouteIndex(object):
+    """ Matches slugs against the page patterns of site.yaml, returning the
+    first pattern in YAML order that fully matches.
+
+    Literal slugs are looked up in a dict. Patterns starting with a literal
+    are stored in a prefix trie, so a slug is only matched against patterns
+    whose prefix it shares. All other patterns are always tried. """
+
+    def __init__(self, patterns):
+        self.routes = [compile(pattern) for pattern in patterns]
+        self.exact = {}
+        self.trie = {}
+        self.fallback = []
+
+        literals = []
+        for index, route in enumerate(self.routes):
+            prefix, literal = literal_prefix(route.pattern)
+            if literal:
+                literals.append(prefix)
+            elif prefix:
+                node = self.trie
+                for char in prefix:
+                    node = node.setdefault(char, {})
+                node.setdefault(None, []).append(index)
+            else:
+                self.fallback.append(index)
+
+        # resolve literal slugs once, an earlier pattern may shadow them
+        for literal in literals:
+            if literal not in self.exact:
+                self.exact[literal] = self.scan(literal)
+
+    def __iter__(self):
+        return iter(self.routes)
+
+    def __len__(self):
+        return len(self.routes)
+
+    def scan(self, slug):
+        for route in self.routes:
+            match = route.fullmatch(slug)
+            if match:
+                return route, match
+        return None
+
+    def candidates(self, slug):
+        indices = list(self.fallback)
+        node = self.trie
+        for char in slug:
+            node = node.get(char)
+            if node is None:
+                break
+            indices.extend(node.get(None, ()))
+        return sorted(indices)
+
+    def match(self, slug):
+        if slug in self.exact:
+            return self.exact[slug]
+
+        for index in self.candidates(slug):
+            route = self.routes[index]
+            match = route.fullmatch(slug)
+            if match:
+                return route, match
+
+        return None
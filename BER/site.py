@@ -0,0 +1,167 @@
+import logging
+import os
+from time import time
+
+from jinja2 import Environment
+
+from prometheus_client import Counter, Gauge, Summary
+
+import tornado.ioloop
+
+import yaml
+
+from .cache import DATA_CACHE_SETTINGS, VARY_DIMENSIONS
+from .routes import RouteIndex
+
+
+log = logging.getLogger(__name__)
+
+
+def validate_site(site):
+    if not isinstance(site, dict):
+        raise ValueError('site.yaml has to be a mapping')
+    if not isinstance(site.get('pages'), dict):
+        raise ValueError('site.yaml has to define pages')
+
+    for slug, page in site['pages'].items():
+        if page is None:
+            continue
+        if not isinstance(page, dict):
+            raise ValueError(f'page {slug} has to be a mapping')
+        vary = page.get('response_cache', {}).get('vary', [])
+        if not isinstance(vary, list) or \
+                not all(dimension in VARY_DIMENSIONS for dimension in vary):
+            raise ValueError(
+                f'response_cache of page {slug} can only vary on '
+                f'{", ".join(VARY_DIMENSIONS)}')
+        concurrency = page.get('data_sources_concurrency')
+        if concurrency is not None and (
+                not isinstance(concurrency, int) or concurrency < 1):
+            raise ValueError(
+                f'data_sources_concurrency of page {slug} has to be a '
+                'positive integer')
+        for name, source in page.get('data_sources', {}).items():
+            if 'src' not in source or 'format' not in source:
+                raise ValueError(
+                    f'data source {name} of page {slug} needs src and format')
+            limit = source.get('limit')
+            if limit is not None and (
+                    not isinstance(limit, int) or limit < 1):
+                raise ValueError(
+                    f'limit of data source {name} of page {slug} has to be '
+                    'a positive integer')
+            interval = source.get('refresh_interval')
+            if interval is not None and (
+                    not isinstance(interval, (int, float)) or interval <= 0):
+                raise ValueError(
+                    f'refresh_interval of data source {name} of page {slug} '
+                    'has to be a positive number')
+            timeout = source.get('timeout')
+            if timeout is not None and (
+                    not isinstance(timeout, (int, float)) or
+                    not timeout > 0):
+                raise ValueError(
+                    f'timeout of data source {name} of page {slug} has to '
+                    'be a positive number')
+            fields = source.get('fields')
+            if fields is not None and not isinstance(fields, list):
+                raise ValueError(
+                    f'fields of data source {name} of page {slug} has to be '
+                    'a list')
+            if 'cache' in source:
+                validate_data_cache(source['cache'], name, slug)
+
+
+def validate_data_cache(cache, name, slug):
+    if not isinstance(cache, dict) or \
+            not all(setting in DATA_CACHE_SETTINGS for setting in cache):
+        raise ValueError(
+            f'cache of data source {name} of page {slug} can only set '
+            f'{", ".join(DATA_CACHE_SETTINGS)}')
+    for setting in ('ttl', 'stale_ttl'):
+        value = cache.get(setting, 0)
+        if not isinstance(value, (int, float)) or not value >= 0:
+            raise ValueError(
+                f'{setting} of the cache of data source {name} of page '
+                f'{slug} has to be a number, 0 or more')
+    max_entries = cache.get('max_entries', 1)
+    if not isinstance(max_entries, int) or max_entries < 1:
+        raise ValueError(
+            f'max_entries of the cache of data source {name} of page {slug} '
+            'has to be a positive integer')
+
+
+def init_site(site_path):
+    with open(site_path) as f:
+        t = Environment().from_string(f.read())
+        site = yaml.full_load(t.render(environ=os.environ))
+
+    validate_site(site)
+    site['routes'] = RouteIndex(site['pages'])
+
+    return site
+
+
+class SiteReloader(object):
+    """ Watches site.yaml and swaps a freshly built site into the
+    application's settings when it changes. Requests already running keep
+    the site they started with. """
+
+    reload_time = Summary(
+        'site_reload_seconds', 'Time spent reloading site.yaml.')
+    reload_failures = Counter(
+        'site_reload_failures_total', 'Failed site.yaml reloads.')
+    last_reload = Gauge(
+        'site_last_reload_timestamp_seconds',
+        'Time of the last successful site.yaml reload.',
+        multiprocess_mode='max')
+
+    def __init__(self, application, site_path, interval=2):
+        self.application = application
+        self.site_path = site_path
+        self.interval = interval
+        self.mtime = self.get_mtime()
+        self.watcher = None
+
+    def get_mtime(self):
+        try:
+            return os.stat(self.site_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def check(self):
+        mtime = self.get_mtime()
+        if mtime is not None and mtime != self.mtime:
+            self.mtime = mtime
+            self.reload()
+
+    def reload(self):
+        start_time = time()
+        try:
+            site = init_site(self.site_path)
+        except Exception:
+            self.reload_failures.inc()
+            log.exception('reloading %s failed, keeping the current site',
+                          self.site_path)
+            return False
+
+        self.application.settings['site'] = site
+
+        engine = getattr(self.application, 'engine', None)
+        if engine is not None:
+            engine.response_cache.clear()
+            engine.prune_data_caches(site)
+
+        self.reload_time.observe(time() - start_time)
+        self.last_reload.set_to_current_time()
+        return True
+
+    def start(self):
+        self.watcher = tornado.ioloop.PeriodicCallback(
+            self.check, self.interval * 1000)
+        self.watcher.start()
+
+    def stop(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
@@ -0,0 +1,35 @@
+from contextlib import contextmanager, nullcontext
+from time import perf_counter
+
+
+def null_phase(name, description=None):
+    return nullcontext()
+
+
+class RequestTimer(object):
+    """ Records how long the phases of a request took, in the order they
+    finished. A phase may be recorded more than once, e.g. a fetch per data
+    source, told apart by its description. """
+
+    def __init__(self):
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name, description=None):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, description, perf_counter() - start))
+
+    def header(self):
+        """ The recorded phases as a Server-Timing header value. """
+        entries = []
+        for name, description, duration in self.phases:
+            entry = name
+            if description is not None:
+                description = description.replace('\\', '\\\\')
+                description = description.replace('"', '\\"')
+                entry += f';desc="{description}"'
+            entries.append(f'{entry};dur={duration * 1000:.2f}')
+        return ', '.join(entries)
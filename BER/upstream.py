@@ -0,0 +1,125 @@
+import weakref
+from collections import defaultdict
+from time import time
+from urllib.parse import urlsplit
+
+from prometheus_client import Counter, Summary
+
+import tornado.gen
+import tornado.httpclient
+import tornado.ioloop
+import tornado.locks
+
+from .metrics import LabelLimiter
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """ Opens after `failures` consecutive failures and rejects requests
+    until `reset_timeout` seconds passed. Then a single trial request is let
+    through, closing the circuit again if it succeeds. """
+
+    def __init__(self, failures=5, reset_timeout=30):
+        self.max_failures = failures
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    @property
+    def open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if self.trial or time() < self.opened_at + self.reset_timeout:
+            return False
+        self.trial = True
+        return True
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def failure(self):
+        self.failures += 1
+        self.trial = False
+        if self.opened_at is not None or self.failures >= self.max_failures:
+            self.opened_at = time()
+
+
+class UpstreamClient(object):
+    queue_wait = Summary(
+        'upstream_queue_wait_seconds',
+        'Time upstream requests waited for a connection to their host.',
+        ['host'])
+    rejected_total = Counter(
+        'upstream_circuit_rejected_total',
+        'Upstream requests rejected by an open circuit breaker.',
+        ['host'])
+    host_label = LabelLimiter()
+
+    def __init__(self, max_clients=100, max_per_host=10, curl=False,
+                 connect_timeout=None, request_timeout=None, breaker=None):
+        self.max_clients = max_clients
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+
+        if curl:
+            from tornado.curl_httpclient import CurlAsyncHTTPClient
+            self.client_class = CurlAsyncHTTPClient
+        else:
+            self.client_class = tornado.httpclient.AsyncHTTPClient
+
+        self.clients = weakref.WeakKeyDictionary()
+        self.semaphores = defaultdict(
+            lambda: tornado.locks.Semaphore(max_per_host))
+        self.breakers = defaultdict(lambda: CircuitBreaker(**(breaker or {})))
+
+    @property
+    def client(self):
+        # clients are bound to an IOLoop, workers each get their own
+        loop = tornado.ioloop.IOLoop.current()
+        if loop not in self.clients:
+            self.clients[loop] = self.client_class(
+                force_instance=True, max_clients=self.max_clients)
+        return self.clients[loop]
+
+    @tornado.gen.coroutine
+    def fetch(self, request):
+        host = urlsplit(request.url).netloc
+        label = self.host_label(host)
+
+        breaker = self.breakers[host]
+        if not breaker.allow():
+            self.rejected_total.labels(label).inc()
+            raise CircuitOpenError(host)
+
+        if request.connect_timeout is None:
+            request.connect_timeout = self.connect_timeout
+        if request.request_timeout is None:
+            request.request_timeout = self.request_timeout
+
+        start_time = time()
+        with (yield self.semaphores[host].acquire()):
+            self.queue_wait.labels(label).observe(time() - start_time)
+            try:
+                response = yield self.client.fetch(request)
+            except tornado.httpclient.HTTPClientError as e:
+                # client errors and 304s still mean the host is healthy
+                if e.code >= 500:
+                    breaker.failure()
+                else:
+                    breaker.success()
+                raise
+            except Exception:
+                breaker.failure()
+                raise
+
+        breaker.success()
+        return response
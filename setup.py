@@ -19,5 +19,9 @@ setup(
         "feedparser",
         "misaka",
         "prometheus-client"
-    ]
+    ],
+    extras_require={
+        "brotli": ["brotli"],
+        "curl": ["pycurl"]
+    }
 )
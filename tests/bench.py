@@ -0,0 +1,341 @@
+""" Benchmarks for the request path, built on the tests/site fixture with a
+local stub standing in for remote data sources.
+
+    python tests/bench.py                      # print results
+    python tests/bench.py --update             # store them as baseline
+    python tests/bench.py --check              # fail on regressions
+
+Results are compared to tests/bench_baseline.json relative to a
+calibration loop timed in the same run, so the comparison holds across
+machines of different speed. Timings (`_us`, `_ms`) regress when they grow
+by more than the threshold, throughput (`_rps`) when it drops by more than
+it. Only the in-process timings (`_us`) fail --check, the ones going
+through sockets vary too much between runs and are just reported. Literal
+route lookups also fail it unless they take about as long on a synthetic
+site of 2000 pages as on one of 20. A failing run is repeated once. """
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import textwrap
+from time import perf_counter
+
+APP_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, APP_ROOT)
+
+from BER import make_app  # noqa: E402
+from BER.mitte import Engine, parse_data  # noqa: E402
+from BER.routes import RouteIndex  # noqa: E402
+
+import tornado.gen  # noqa: E402
+import tornado.httpclient  # noqa: E402
+import tornado.httpserver  # noqa: E402
+import tornado.ioloop  # noqa: E402
+import tornado.testing  # noqa: E402
+import tornado.web  # noqa: E402
+
+import yaml  # noqa: E402
+
+
+BASELINE = os.path.join(APP_ROOT, 'tests', 'bench_baseline.json')
+SOURCE_COUNTS = (1, 5, 20)
+ROUTE_COUNTS = (20, 200, 2000)
+# how much slower a literal lookup may get from the smallest to the largest
+# site before it no longer counts as constant time
+FLAT_LIMIT = 3
+# results that fail --check, timed in process and steady between runs
+GATED_SUFFIX = '_us'
+
+ITEMS = [{'title': f'Item {i}', 'link': f'https://example.com/{i}',
+          'summary': 'Lorem ipsum dolor sit amet. ' * 5}
+         for i in range(100)]
+PAYLOADS = {
+    'json': json.dumps(ITEMS),
+    'yaml': yaml.safe_dump(ITEMS),
+    'rss': ('<?xml version="1.0"?><rss version="2.0"><channel>'
+            '<title>Bench</title><link>https://example.com</link>' +
+            ''.join(f'<item><title>{item["title"]}</title>'
+                    f'<link>{item["link"]}</link>'
+                    f'<description>{item["summary"]}</description></item>'
+                    for item in ITEMS) +
+            '</channel></rss>')}
+
+
+class StubUpstreamHandler(tornado.web.RequestHandler):
+    def get(self, format):
+        self.write(PAYLOADS[format])
+
+
+def per_op(fn, number, repeat=5):
+    """ Best time per call of `fn` over `repeat` runs of `number` calls. """
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = (perf_counter() - start) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def calibration_loop():
+    counts = {}
+    for i in range(1000):
+        key = str(i % 100)
+        counts[key] = counts.get(key, 0) + i
+    return sorted(counts.values())
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def write_bench_site(target, upstream):
+    site_dir = os.path.join(target, 'site')
+    shutil.copytree(
+        os.path.join(APP_ROOT, 'tests', 'site'), site_dir,
+        ignore=shutil.ignore_patterns('dist', '.webassets-cache'))
+
+    pages = {}
+    for count in SOURCE_COUNTS:
+        pages[f'/sources-{count}'] = {
+            'tpl_name': 'index.html',
+            'title': f'{count} Sources',
+            'data_sources': {
+                f'source_{i}': {'format': 'json',
+                                'src': f'{upstream}/json?source={i}'}
+                for i in range(count)}}
+
+    with open(os.path.join(site_dir, 'site.yaml'), 'a') as f:
+        # the fixture's site.yaml ends with its pages
+        f.write(textwrap.indent(yaml.safe_dump(pages), '  '))
+    return site_dir
+
+
+def bench_route_lookup(app, results):
+    routes = app.settings['site']['routes']
+    for name, slug in (('literal', '/test-assets'),
+                       ('pattern', '/test-wildcard_slugs/a/b/c/test'),
+                       ('miss', '/does-not-exist')):
+        results[f'route_lookup_{name}_us'] = per_op(
+            lambda: routes.match(slug), 10000) * 1e6
+
+
+def bench_route_scaling(results):
+    for count in ROUTE_COUNTS:
+        # mostly literal pages, every tenth a pattern
+        patterns = []
+        for i in range(count):
+            if i % 10 == 0:
+                patterns.append(f'/section-{i}/(?P<slug>[a-z0-9-]+)')
+            else:
+                patterns.append(f'/page-{i}')
+        routes = RouteIndex(patterns)
+        slug = f'/page-{count - 1}'
+        results[f'route_lookup_literal_{count}_pages_us'] = per_op(
+            lambda: routes.match(slug), 100000) * 1e6
+
+
+def route_scaling(results):
+    """ How much slower a literal lookup is on the largest synthetic site
+    than on the smallest. """
+    times = [results[f'route_lookup_literal_{count}_pages_us']
+             for count in ROUTE_COUNTS]
+    return max(times) / min(times)
+
+
+def bench_render(app, results):
+    engine = Engine.for_application(app)
+    template = engine.get_template('index.html')
+    site = app.settings['site']
+    context = dict(site=site, page=site['pages']['/'], host='localhost',
+                   protocol='http', arguments={})
+    template.render(**context)
+    results['render_index_us'] = per_op(
+        lambda: template.render(**context), 500) * 1e6
+
+
+def bench_parse(results):
+    for format, payload in PAYLOADS.items():
+        results[f'parse_{format}_us'] = per_op(
+            lambda: parse_data(format, payload), 20) * 1e6
+
+
+@tornado.gen.coroutine
+def bench_data_sources(client, base_url, results, requests=30):
+    for count in SOURCE_COUNTS:
+        url = f'{base_url}/sources-{count}'
+        yield client.fetch(url)
+
+        latencies = []
+        for _ in range(requests):
+            start = perf_counter()
+            yield client.fetch(url)
+            latencies.append(perf_counter() - start)
+        results[f'data_sources_{count}_p50_ms'] = \
+            statistics.median(latencies) * 1e3
+
+
+@tornado.gen.coroutine
+def bench_end_to_end(client, base_url, results, total=1000, concurrency=25):
+    url = f'{base_url}/'
+    yield client.fetch(url)
+
+    latencies = []
+    pending = iter(range(total))
+
+    @tornado.gen.coroutine
+    def worker():
+        for _ in pending:
+            start = perf_counter()
+            yield client.fetch(url)
+            latencies.append(perf_counter() - start)
+
+    start = perf_counter()
+    yield [worker() for _ in range(concurrency)]
+    elapsed = perf_counter() - start
+
+    results['end_to_end_rps'] = total / elapsed
+    results['end_to_end_p50_ms'] = percentile(latencies, 0.5) * 1e3
+    results['end_to_end_p99_ms'] = percentile(latencies, 0.99) * 1e3
+
+
+@tornado.gen.coroutine
+def run_benchmarks(tmp):
+    upstream = tornado.web.Application([(r'/(json|yaml|rss)',
+                                         StubUpstreamHandler)])
+    sock, port = tornado.testing.bind_unused_port()
+    upstream_server = tornado.httpserver.HTTPServer(upstream)
+    upstream_server.add_sockets([sock])
+
+    site_dir = write_bench_site(tmp, f'http://127.0.0.1:{port}')
+    app = make_app(site_dir, force_https=False, compress_response=False)
+    Engine.for_application(app).warmup()
+    sock, port = tornado.testing.bind_unused_port()
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets([sock])
+    base_url = f'http://127.0.0.1:{port}'
+
+    results = {}
+    bench_route_lookup(app, results)
+    bench_route_scaling(results)
+    bench_render(app, results)
+    bench_parse(results)
+
+    client = tornado.httpclient.AsyncHTTPClient(
+        force_instance=True, max_clients=50)
+    yield bench_data_sources(client, base_url, results)
+    yield bench_end_to_end(client, base_url, results)
+    client.close()
+
+    server.stop()
+    upstream_server.stop()
+    return results
+
+
+def normalized(results):
+    """ The results in calibration loops, instead of wall time. """
+    calibration = results['calibration_us']
+    normalized = {}
+    for name, value in results.items():
+        if name == 'calibration_us':
+            continue
+        if name.endswith('_rps'):
+            normalized[name] = value * calibration
+        else:
+            normalized[name] = value / calibration
+    return normalized
+
+
+def compare(results, baseline, threshold):
+    results = normalized(results)
+    baseline = normalized(baseline)
+
+    regressions = []
+    for name, value in sorted(results.items()):
+        if name not in baseline:
+            continue
+        expected = baseline[name]
+        if name.endswith('_rps'):
+            regressed = value < expected * (1 - threshold)
+        else:
+            regressed = value > expected * (1 + threshold)
+        if regressed:
+            regressions.append(
+                (name, expected, value, name.endswith(GATED_SUFFIX)))
+    return regressions
+
+
+def check(results, baseline, threshold):
+    regressions = []
+    if baseline is not None:
+        regressions = compare(results, baseline, threshold)
+    return regressions, route_scaling(results)
+
+
+def failed(regressions, scaling):
+    return scaling > FLAT_LIMIT or any(gated for *_, gated in regressions)
+
+
+def run():
+    # timed before and after, a machine warming up or busy for a moment
+    # would skew every normalized result. Outside the benchmarks, the
+    # servers and data pools they start still use the cpu for a while.
+    calibration = per_op(calibration_loop, 200, repeat=10)
+    with tempfile.TemporaryDirectory() as tmp:
+        results = tornado.ioloop.IOLoop.current().run_sync(
+            lambda: run_benchmarks(tmp))
+    calibration = min(calibration, per_op(calibration_loop, 200, repeat=10))
+    results['calibration_us'] = calibration * 1e6
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument(
+        '--threshold', type=float, default=0.5,
+        help='allowed relative regression before failing, default 0.5')
+    parser.add_argument(
+        '--check', action='store_true', help='exit non-zero on regressions')
+    parser.add_argument(
+        '--update', action='store_true',
+        help='store the results as the new baseline')
+    args = parser.parse_args(argv)
+
+    results = run()
+    for name, value in sorted(results.items()):
+        print(f'{name:32} {value:12.2f}')
+
+    if args.update:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+        return 0
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    regressions, scaling = check(results, baseline, args.threshold)
+    if args.check and failed(regressions, scaling):
+        print('regressions found, running again')
+        regressions, scaling = check(run(), baseline, args.threshold)
+
+    for name, expected, value, gated in regressions:
+        print(f'regression: {name} {value:.4g}, baseline {expected:.4g} '
+              f'calibration loops{"" if gated else ", reported only"}')
+    if scaling > FLAT_LIMIT:
+        print(f'regression: literal route lookups are {scaling:.2f}x slower '
+              f'with {ROUTE_COUNTS[-1]} pages than with {ROUTE_COUNTS[0]}')
+    return 1 if args.check and failed(regressions, scaling) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,46 @@
+import gzip
+import json
 import os
+import re
+import shutil
 import sys
-
-from BER import PageHandler, init_site
-
+import tempfile
+import unittest
+from time import sleep, time
+
+from BER import (PageHandler,
+                 Prefetcher,
+                 ProfileHandler,
+                 SiteReloader,
+                 init_site,
+                 make_app,
+                 make_settings)
+from BER.__main__ import main
+from BER.assets import FINGERPRINTED, MANIFEST, load_manifest, walk_files
+from BER.cache import (DataCache,
+                       LRUCache,
+                       LocalDataCache,
+                       ResponseCacheEntry,
+                       stat_key)
+from BER.compression import accepted_encodings
+from BER.metrics import LabelLimiter, OVERFLOW
+from BER.mitte import Engine, parse_data
+from BER.pool import DataExecutor
+from BER.projection import Projection, truncate_feed
+from BER.upstream import CircuitBreaker, CircuitOpenError, UpstreamClient
+from BER.routes import RouteIndex, literal_prefix
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from prometheus_client import REGISTRY
+
+import tornado.gen
+import tornado.httpclient
 import tornado.web
-from tornado.testing import AsyncHTTPTestCase
+from tornado.testing import AsyncHTTPTestCase, AsyncTestCase, gen_test
 
 
 # add application root to sys.path
@@ -12,6 +48,49 @@ APP_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(os.path.join(APP_ROOT, '..'))
 
 
+class SlowHandler(tornado.web.RequestHandler):
+
+    @tornado.gen.coroutine
+    def get(self):
+        yield tornado.gen.sleep(float(self.get_argument('delay')))
+        self.write({'key': 'slow'})
+
+
+class BlockingHandler(tornado.web.RequestHandler):
+
+    def get(self):
+        sleep(float(self.get_argument('delay')))
+        self.write({'key': 'blocking'})
+
+
+class CounterHandler(tornado.web.RequestHandler):
+    count = 0
+
+    def get(self):
+        CounterHandler.count += 1
+        self.write({'count': CounterHandler.count})
+
+
+class ErrorHandler(tornado.web.RequestHandler):
+    requests = 0
+
+    def get(self):
+        ErrorHandler.requests += 1
+        raise tornado.web.HTTPError(500)
+
+
+class ConditionalHandler(tornado.web.RequestHandler):
+    not_modified = 0
+
+    def get(self):
+        self.set_header('ETag', '"v1"')
+        if self.request.headers.get('If-None-Match') == '"v1"':
+            ConditionalHandler.not_modified += 1
+            self.set_status(304)
+            return
+        self.write({'key': 'conditional'})
+
+
 class TestApplication(tornado.web.Application):
 
     def __init__(self):
@@ -34,6 +113,9 @@ class TestApplication(tornado.web.Application):
         handlers = [(r"/assets/(.*)",
                      tornado.web.StaticFileHandler,
                      dict(path=settings['static_path'])),
+                    (r"/slow", SlowHandler),
+                    (r"/counter", CounterHandler),
+                    (r"/conditional", ConditionalHandler),
                     (r"(/[a-z0-9\-_\/\.]*)$", PageHandler)]
 
         tornado.web.Application.__init__(self, handlers, **settings)
@@ -118,6 +200,20 @@ class TestPageHandler(TestHandlerBase):
         self.assertEqual(200, response.code)
         self.assertEqual(b'<h1>Markdown Test</h1>\n', response.body)
 
+    def test_markdown_filter_memoized(self):
+        engine = Engine.for_application(test_app)
+        labels = {'result': 'hit'}
+        self.fetch('/markdown')
+        hits = REGISTRY.get_sample_value(
+            'markdown_cache_lookup_total', labels) or 0
+
+        response = self.fetch('/markdown')
+        self.assertEqual(b'<h1>Markdown Test</h1>\n', response.body)
+        self.assertEqual(hits + 1, REGISTRY.get_sample_value(
+            'markdown_cache_lookup_total', labels))
+        self.assertIs(engine.markdown('# Markdown Test'),
+                      engine.markdown('# Markdown Test'))
+
     def test_unpublished_page(self):
         """ test that pages marked as unpublished return 404 """
 
@@ -244,6 +340,20 @@ class TestPageHandler(TestHandlerBase):
         self.assertEqual(200, response.code)
         self.assertEqual(response.headers['Content-Type'], 'application/xml')
 
+    def test_streamed_page(self):
+        rendered = self.fetch('/sitemap.xml')
+
+        test_app.settings['stream_buffer_size'] = 64
+        try:
+            streamed = self.fetch('/sitemap-streamed.xml')
+        finally:
+            del test_app.settings['stream_buffer_size']
+
+        self.assertEqual(200, streamed.code)
+        self.assertEqual('chunked', streamed.headers['Transfer-Encoding'])
+        self.assertEqual('application/xml', streamed.headers['Content-Type'])
+        self.assertEqual(rendered.body, streamed.body)
+
     def test_redirect(self):
 
         response = self.fetch(
@@ -263,3 +373,996 @@ class TestPageHandler(TestHandlerBase):
         self.assertEqual(404, response.code)
         expected_h1 = b'<h1>404 Page Not Found</h1>'
         self.assertIn(expected_h1, response.body)
+
+    def test_engine_shared_across_requests(self):
+        """ test that the template engine is built once per application and
+        that request globals are passed in at render time """
+
+        first = self.fetch('/sitemap.xml', method='GET')
+        engine = test_app.engine
+        template = engine.get_template('/sitemap.xml')
+
+        second = self.fetch(
+            '/sitemap.xml', method='GET', headers={'Host': 'example.com'})
+        self.assertIs(engine, test_app.engine)
+        self.assertIs(template, engine.get_template('/sitemap.xml'))
+
+        port = self.get_http_port()
+        self.assertIn(
+            f'<loc>http://127.0.0.1:{port}</loc>'.encode(), first.body)
+        self.assertIn(b'<loc>http://example.com</loc>', second.body)
+
+    def test_data_sources_fetched_concurrently(self):
+        port = self.get_http_port()
+
+        start = time()
+        response = self.fetch(f'/concurrent-data-sources/{port}')
+        self.assertEqual(200, response.code)
+        self.assertLess(time() - start, 0.5)
+
+        start = time()
+        response = self.fetch(f'/limited-data-sources/{port}')
+        self.assertEqual(200, response.code)
+        self.assertGreaterEqual(time() - start, 0.6)
+
+    def test_data_source_timeout(self):
+        port = self.get_http_port()
+        response = self.fetch(f'/data-source-timeout/{port}')
+        self.assertEqual(504, response.code)
+
+    def test_concurrency_limit_holds_after_timeout(self):
+        """ test that a timed out fetch keeps its slot until it finished,
+        so the second source only starts after the first fetch is done """
+        port = self.get_http_port()
+
+        start = time()
+        response = self.fetch(f'/limited-data-source-timeout/{port}')
+        self.assertEqual(504, response.code)
+        self.assertGreaterEqual(time() - start, 0.4)
+
+    def test_data_source_errors_raised_in_declared_order(self):
+        """ test that the first declared failing source decides the status,
+        even if a later source fails first """
+        port = self.get_http_port()
+        response = self.fetch(f'/data-source-errors-in-order/{port}')
+        self.assertEqual(504, response.code)
+
+    def test_cached_remote_data_source(self):
+        port = self.get_http_port()
+        first = self.fetch(f'/cached-data-source/{port}')
+        self.assertEqual(200, first.code)
+        second = self.fetch(f'/cached-data-source/{port}')
+        self.assertEqual(200, second.code)
+        self.assertEqual(first.body, second.body)
+
+    def test_data_caches_with_different_settings(self):
+        """ test that sources sharing a src with different cache settings
+        don't replace each other's cache """
+        port = self.get_http_port()
+        count = CounterHandler.count
+
+        for _ in range(3):
+            for slug in ('/shared-cached-data-source',
+                         '/shared-cached-data-source-longer'):
+                response = self.fetch(f'{slug}/{port}')
+                self.assertEqual(200, response.code)
+
+        self.assertEqual(count + 2, CounterHandler.count)
+
+    def test_cached_remote_data_source_revalidation(self):
+        """ test that a stale source is revalidated with If-None-Match and
+        that a 304 keeps the parsed data instead of parsing it again """
+        port = self.get_http_port()
+        response = self.fetch(f'/revalidated-data-source/{port}')
+        self.assertEqual(200, response.code)
+        self.assertIn(b"{'key': 'conditional'}", response.body)
+
+        cache = test_app.engine.get_data_cache(
+            test_app.settings['site']['pages']
+            ['/revalidated-data-source/(?P<port>[0-9]+)']
+            ['data_sources']['wildcard_data'])
+        key = (f'http://localhost:{port}/conditional', 'json', None)
+        parsed = cache.entries.get(key).value
+        not_modified = ConditionalHandler.not_modified
+
+        response = self.fetch(f'/revalidated-data-source/{port}')
+        self.assertEqual(200, response.code)
+        self.io_loop.run_sync(lambda: tornado.gen.sleep(0.05))
+
+        self.assertEqual(not_modified + 1, ConditionalHandler.not_modified)
+        self.assertIs(parsed, cache.entries.get(key).value)
+
+    def test_cached_response(self):
+        """ test that cached responses are served without rendering, vary on
+        the configured dimensions and answer If-None-Match with a 304 """
+        port = self.get_http_port()
+        first = self.fetch(f'/cached-response/{port}')
+        self.assertEqual(200, first.code)
+        self.assertIn('Etag', first.headers)
+
+        second = self.fetch(f'/cached-response/{port}')
+        self.assertEqual(first.body, second.body)
+        self.assertEqual(first.headers['Etag'], second.headers['Etag'])
+
+        other = self.fetch(f'/cached-response/{port}?page=2')
+        self.assertNotEqual(first.body, other.body)
+
+        not_modified = self.fetch(
+            f'/cached-response/{port}',
+            headers={'If-None-Match': first.headers['Etag']})
+        self.assertEqual(304, not_modified.code)
+
+    def test_shared_data_source_loaded_once(self):
+        port = self.get_http_port()
+        count = CounterHandler.count
+
+        response = self.fetch(f'/shared-data-source/{port}')
+        self.assertEqual(200, response.code)
+        self.assertEqual(count + 1, CounterHandler.count)
+        self.assertEqual(
+            2, response.body.count(f"{{'count': {count + 1}}}".encode()))
+
+    def test_projected_data_source(self):
+        response = self.fetch('/projected-data-source')
+        self.assertEqual(200, response.code)
+
+        # the projected and the full source are cached apart
+        self.assertIn(
+            b"<li>[{'title': 'First'}, {'title': 'Second'}]</li>",
+            response.body)
+        self.assertIn(b"'body': 'three'", response.body)
+
+    def test_large_payloads_parsed_off_loop(self):
+        settings = test_app.settings
+        labels = {'task': 'parse_data'}
+        before = REGISTRY.get_sample_value(
+            'data_executor_execution_seconds_count', labels) or 0
+
+        Engine.for_application(test_app).local_data_cache.clear()
+        settings['parse_offload_threshold'] = 0
+        try:
+            response = self.fetch('/markdown')
+        finally:
+            del settings['parse_offload_threshold']
+
+        self.assertEqual(200, response.code)
+        self.assertEqual(before + 1, REGISTRY.get_sample_value(
+            'data_executor_execution_seconds_count', labels))
+
+    def test_server_timing(self):
+        port = self.get_http_port()
+        url = f'/concurrent-data-sources/{port}'
+        labels = {'route': '/concurrent-data-sources/(?P<port>[0-9]+)',
+                  'phase': 'fetch'}
+        before = REGISTRY.get_sample_value(
+            'request_phase_seconds_count', labels) or 0
+
+        response = self.fetch(url)
+        self.assertNotIn('Server-Timing', response.headers)
+        self.assertEqual(before + 3, REGISTRY.get_sample_value(
+            'request_phase_seconds_count', labels))
+
+        test_app.settings['server_timing'] = True
+        try:
+            response = self.fetch(url)
+        finally:
+            del test_app.settings['server_timing']
+
+        phases = {}
+        for entry in response.headers['Server-Timing'].split(', '):
+            name, *params = entry.split(';')
+            params = dict(param.split('=', 1) for param in params)
+            phases.setdefault(name, []).append(params)
+
+        self.assertEqual(
+            {'route', 'fetch', 'parse', 'template', 'render'}, set(phases))
+        self.assertEqual(
+            {'"test_data_1"', '"test_data_2"', '"test_data_remote"'},
+            {params['desc'] for params in phases['fetch']})
+        for params in phases['fetch']:
+            self.assertGreaterEqual(float(params['dur']), 200)
+
+    def test_metrics_labelled_by_route(self):
+        labels = {'method': 'GET', 'route': '/test-wildcard_slugs/a/.*',
+                  'status': '2xx'}
+        before = REGISTRY.get_sample_value('request_total', labels) or 0
+
+        self.fetch('/test-wildcard_slugs/a/one?q=1')
+        self.fetch('/test-wildcard_slugs/a/two')
+
+        self.assertEqual(
+            before + 2, REGISTRY.get_sample_value('request_total', labels))
+        self.assertIsNotNone(REGISTRY.get_sample_value(
+            'request_duration_seconds_count',
+            {'route': '/test-wildcard_slugs/a/.*'}))
+
+    def test_data_source_metrics_labelled_by_name(self):
+        self.fetch('/test-wildcard_slugs-data_source/wildcard_data')
+        self.assertIsNotNone(REGISTRY.get_sample_value(
+            'get_data_time_count',
+            {'source': 'wildcard_data', 'format': 'json'}))
+
+    def test_label_limiter_overflow(self):
+        limit = LabelLimiter(max_values=2)
+        self.assertEqual(['a', 'b', OVERFLOW, 'a'],
+                         [limit(v) for v in ['a', 'b', 'c', 'a']])
+
+
+def copy_test_site(target):
+    site_dir = os.path.join(target, 'site')
+    shutil.copytree(
+        os.path.join(APP_ROOT, 'tests', 'site'), site_dir,
+        ignore=shutil.ignore_patterns('dist', '.webassets-cache'))
+    return site_dir
+
+
+class TestBuiltAssets(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.site_dir = copy_test_site(self.tmp.name)
+
+        self.large_css = b'body { color: #333; }\n' * 200
+        with open(os.path.join(
+                self.site_dir, 'assets', 'css', 'large.css'), 'wb') as f:
+            f.write(self.large_css)
+
+        main(['build-assets', self.site_dir])
+
+        # sources aren't needed anymore once the bundles are built
+        os.remove(os.path.join(
+            self.site_dir, 'assets', 'css', 'style.css.scss'))
+
+        return make_app(self.site_dir, force_https=False)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        super(TestBuiltAssets, self).tearDown()
+
+    def restore_sources(self):
+        shutil.copy(
+            os.path.join(APP_ROOT, 'tests', 'site', 'assets', 'css',
+                         'style.css.scss'),
+            os.path.join(self.site_dir, 'assets', 'css'))
+
+    def test_fingerprinted_asset_urls(self):
+        response = self.fetch('/')
+        self.assertEqual(200, response.code)
+
+        expected_stylesheet_regexp = rb'href="/assets/(dist/css/style\.[0-9a-f]{12}\.css)"'  # noqa: E501
+        self.assertRegex(response.body, expected_stylesheet_regexp)
+        self.assertRegex(
+            response.body, rb'src="/assets/dist/js/app\.[0-9a-f]{12}\.js"')
+
+        path = re.search(expected_stylesheet_regexp, response.body).group(1)
+        css_response = self.fetch('/assets/' + path.decode())
+        self.assertEqual(200, css_response.code)
+        self.assertIn('immutable', css_response.headers['Cache-Control'])
+        self.assertIn(b'font: 100% Helvetica, sans-serif;', css_response.body)
+
+    def test_metrics_handler(self):
+        self.fetch('/')
+        response = self.fetch('/metrics')
+        self.assertEqual(200, response.code)
+        self.assertIn(b'request_total{method="GET",route="/"', response.body)
+
+    def test_only_current_copies_kept(self):
+        static_path = os.path.join(self.site_dir, 'assets')
+        with open(os.path.join(static_path, 'css', 'large.css'), 'ab') as f:
+            f.write(b'p { margin: 0; }\n')
+        self.restore_sources()
+        # hashed by the site itself, not by a build
+        vendored = 'js/vendor.0123456789ab.js'
+        with open(os.path.join(static_path, 'js', 'vendor.0123456789ab.js'),
+                  'w') as f:
+            f.write('var vendor;\n')
+
+        main(['build-assets', self.site_dir])
+
+        manifest = load_manifest(os.path.join(static_path, MANIFEST))
+        self.assertNotIn('css/style.css.scss', manifest)
+        copies = [name for name in walk_files(static_path)
+                  if FINGERPRINTED.search(name) and name != vendored]
+        self.assertTrue(copies)
+        for name in copies:
+            self.assertIn(re.sub(r'\.(gz|br)$', '', name), manifest.values())
+        self.assertIn(vendored, list(walk_files(static_path)))
+
+    def test_engine_warmup(self):
+        engine = Engine(self._app.settings)
+        templates = os.listdir(os.path.join(self.site_dir, 'templates'))
+        self.assertEqual(len(templates), engine.warmup())
+
+    def test_precompressed_assets(self):
+        encodings = [('gzip', gzip.decompress)]
+        if brotli is not None:
+            encodings.append(('br', brotli.decompress))
+
+        for encoding, decompress in encodings:
+            response = self.fetch(
+                '/assets/css/large.css', decompress_response=False,
+                headers={'Accept-Encoding': encoding})
+            self.assertEqual(200, response.code)
+            self.assertEqual(encoding, response.headers['Content-Encoding'])
+            self.assertEqual('text/css', response.headers['Content-Type'])
+            self.assertEqual(self.large_css, decompress(response.body))
+
+        response = self.fetch(
+            '/assets/css/large.css', decompress_response=False,
+            headers={'Accept-Encoding': 'identity'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(self.large_css, response.body)
+
+    def test_stale_variants_not_served(self):
+        path = os.path.join(self.site_dir, 'assets', 'css', 'large.css')
+        small_css = b'body { color: #333; }'
+        with open(path, 'wb') as f:
+            f.write(small_css)
+
+        # edited, and not rebuilt yet
+        os.utime(path, (time() + 10, time() + 10))
+        response = self.fetch(
+            '/assets/css/large.css', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(small_css, response.body)
+
+        # rebuilt, too small to compress
+        self.restore_sources()
+        main(['build-assets', self.site_dir])
+        self.assertFalse(os.path.exists(path + '.gz'))
+
+
+class TestTemplateBundle(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.site_dir = copy_test_site(self.tmp.name)
+
+        main(['compile-templates', self.site_dir])
+
+        # pages have to render from the bundle alone
+        shutil.rmtree(os.path.join(self.site_dir, 'templates'))
+        os.mkdir(os.path.join(self.site_dir, 'templates'))
+
+        return make_app(self.site_dir, force_https=False)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        super(TestTemplateBundle, self).tearDown()
+
+    def test_pages_rendered_from_bundle(self):
+        response = self.fetch('/')
+        self.assertEqual(200, response.code)
+        self.assertIn(b'<h1>Index</h1>', response.body)
+
+        response = self.fetch('/test-tpl-name-overwrite')
+        self.assertEqual(200, response.code)
+
+        response = self.fetch('/404-test')
+        self.assertEqual(404, response.code)
+        self.assertIn(b'<h1>404 Page Not Found</h1>', response.body)
+
+    def test_changed_sources_preferred(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            site_dir = copy_test_site(tmp)
+            main(['compile-templates', site_dir])
+
+            path = os.path.join(
+                site_dir, 'templates', 'test-tpl-name-autodetect.html')
+            with open(path, 'a') as f:
+                f.write('<!-- edited -->')
+
+            engine = Engine(make_settings(site_dir))
+            template = engine.get_template('test-tpl-name-autodetect.html')
+            self.assertEqual(path, template.filename)
+            self.assertIn('<!-- edited -->', template.render(site={}))
+
+            # unchanged templates still come from the bundle
+            template = engine.get_template('index.html')
+            self.assertIn('templates.zip', template.filename)
+
+
+class TestExport(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.site_dir = copy_test_site(self.tmp.name)
+        self.export_path = os.path.join(self.site_dir, 'export')
+
+        main(['export', self.site_dir, '--host', 'www.example.com'])
+
+        with open(os.path.join(self.export_path, 'index.html'), 'ab') as f:
+            f.write(b'<!-- exported -->')
+
+        return make_app(self.site_dir, force_https=False)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        super(TestExport, self).tearDown()
+
+    def test_exported_pages(self):
+        with open(os.path.join(self.export_path, 'export.json')) as f:
+            exported = json.load(f)
+        self.assertIn('/', exported)
+        self.assertIn('/test-site-yaml-template-support', exported)
+        # patterned, data sources, redirect, unpublished, request globals
+        for slug in ('/test-wildcard_slugs/a/.*', '/projected-data-source',
+                     '/test-redirect', '/unpublished', '/sitemap.xml'):
+            self.assertNotIn(slug, exported)
+
+    def test_served_from_export(self):
+        response = self.fetch('/')
+        self.assertEqual(200, response.code)
+        self.assertTrue(response.body.endswith(b'<!-- exported -->'))
+        self.assertEqual('text/html; charset=UTF-8',
+                         response.headers['Content-Type'])
+        self.assertEqual('SAMEORIGIN', response.headers['X-Frame-Options'])
+
+        not_modified = self.fetch(
+            '/', headers={'If-None-Match': response.headers['Etag']})
+        self.assertEqual(304, not_modified.code)
+
+        # other pages are still rendered
+        response = self.fetch('/test-wildcard_slugs/a/b/c/test')
+        self.assertEqual(200, response.code)
+
+        response = self.fetch('/sitemap.xml')
+        self.assertIn(
+            f'<loc>http://127.0.0.1:{self.get_http_port()}</loc>'.encode(),
+            response.body)
+
+    def test_reloaded_pages_rendered(self):
+        site = dict(self._app.settings['site'])
+        site['pages'] = dict(site['pages'])
+        site['pages']['/'] = dict(
+            site['pages']['/'], redirect={'target': '/json'})
+        self._app.settings['site'] = site
+
+        response = self.fetch('/', follow_redirects=False)
+        self.assertEqual(302, response.code)
+        self.assertEqual('/json', response.headers['Location'])
+
+    def test_unknown_methods_share_a_label(self):
+        labels = {'method': OVERFLOW, 'route': '/', 'status': '4xx'}
+        before = REGISTRY.get_sample_value('request_total', labels) or 0
+        for method in ('FOO1', 'FOO2'):
+            self.fetch('/', method=method, allow_nonstandard_methods=True)
+
+        self.assertEqual(
+            before + 2, REGISTRY.get_sample_value('request_total', labels))
+        self.assertIsNone(REGISTRY.get_sample_value(
+            'request_total', dict(labels, method='FOO1')))
+
+
+class TestCompression(unittest.TestCase):
+
+    @unittest.skipIf(brotli is None, 'needs the brotli extra')
+    def test_accepted_encodings(self):
+        self.assertEqual(['br', 'gzip'],
+                         accepted_encodings('gzip, deflate, br'))
+        self.assertEqual(['gzip', 'br'],
+                         accepted_encodings('br;q=0.5, gzip'))
+        self.assertEqual(['gzip'], accepted_encodings('gzip, br;q=0'))
+        self.assertEqual([], accepted_encodings(None))
+
+    def test_cached_responses_compressed_once(self):
+        body = b'<p>compress me</p>\n' * 100
+        entry = ResponseCacheEntry(body, {}, 60)
+
+        encoding, gzipped, etag = entry.get_variant(['gzip'])
+        self.assertEqual('gzip', encoding)
+        self.assertEqual(body, gzip.decompress(gzipped))
+        self.assertNotEqual(entry.etag, etag)
+        self.assertIs(gzipped, entry.get_variant(['gzip'])[1])
+
+        self.assertEqual((None, body, entry.etag), entry.get_variant([]))
+
+    def test_small_responses_not_compressed(self):
+        entry = ResponseCacheEntry(b'<p>small</p>', {}, 60)
+        self.assertIsNone(entry.get_variant(['gzip'])[0])
+
+
+class TestLocalDataCache(AsyncTestCase):
+
+    def setUp(self):
+        super(TestLocalDataCache, self).setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'data.json')
+        self.write('{"key": 1}')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        super(TestLocalDataCache, self).tearDown()
+
+    def write(self, data):
+        with open(self.path, 'w') as f:
+            f.write(data)
+        # make sure the change is visible with coarse mtimes too
+        os.utime(self.path, ns=(0, len(data) * 10 ** 9))
+
+    def test_entries_validated_by_mtime_and_size(self):
+        cache = LocalDataCache()
+        stat = stat_key(self.path)
+        cache.set(self.path, 'json', stat, {'key': 1})
+        self.assertEqual(
+            {'key': 1}, cache.get(self.path, 'json', stat).value)
+
+        self.write('{"key": 22}')
+        self.assertIsNone(cache.get(self.path, 'json', stat_key(self.path)))
+
+    def test_size_cap_evicts_least_recently_used(self):
+        cache = LocalDataCache(max_size=10)
+        cache.set('a', 'json', (1, 4), 'a')
+        cache.set('b', 'json', (1, 4), 'b')
+        cache.get('a', 'json')
+        cache.set('c', 'json', (1, 4), 'c')
+        self.assertIsNotNone(cache.get('a', 'json'))
+        self.assertIsNone(cache.get('b', 'json'))
+        self.assertEqual(8, cache.size)
+
+    @gen_test
+    def test_watcher_invalidates_changed_files(self):
+        cache = LocalDataCache()
+        cache.watch(0.01)
+        cache.set(self.path, 'json', stat_key(self.path), {'key': 1})
+        self.assertIsNotNone(cache.get(self.path, 'json'))
+
+        self.write('{"key": 22}')
+        yield tornado.gen.sleep(0.05)
+        self.assertIsNone(cache.get(self.path, 'json'))
+        cache.stop()
+
+
+class TestSiteReloader(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.site_path = os.path.join(self.tmp.name, 'site.yaml')
+        self.write_site('/: {title: "First"}')
+
+        settings = dict(test_app.settings)
+        settings['site'] = init_site(self.site_path)
+        self.app = tornado.web.Application(
+            [(r"(/[a-z0-9\-_\/\.]*)$", PageHandler)], **settings)
+        self.reloader = SiteReloader(self.app, self.site_path)
+        return self.app
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        super(TestSiteReloader, self).tearDown()
+
+    def write_site(self, pages):
+        with open(self.site_path, 'w') as f:
+            f.write(f'name: "Reload"\npages:\n  {pages}\n')
+
+    def test_reload_swaps_site(self):
+        self.assertIn(b'<h1>First</h1>', self.fetch('/').body)
+
+        self.write_site('/: {title: "Second"}')
+        self.assertTrue(self.reloader.reload())
+        self.assertIn(b'<h1>Second</h1>', self.fetch('/').body)
+
+    def test_reload_drops_unused_data_caches(self):
+        source = '/: {{data_sources: {{items: {{src: "http://localhost/", ' \
+            'format: json, cache: {{ttl: {ttl}}}}}}}}}'
+        engine = Engine.for_application(self.app)
+        for ttl in (60, 120):
+            self.write_site(source.format(ttl=ttl))
+            self.assertTrue(self.reloader.reload())
+            engine.get_data_cache(
+                self.app.settings['site']['pages']['/']['data_sources'][
+                    'items'])
+
+        self.assertEqual(
+            [('http://localhost/', 'json', (('ttl', 120),))],
+            list(engine.data_caches))
+
+    def test_invalid_site_keeps_current_site(self):
+        site = self.app.settings['site']
+        failures = REGISTRY.get_sample_value('site_reload_failures_total')
+
+        self.write_site('/(: {title: "Broken"}')
+        self.assertFalse(self.reloader.reload())
+        self.assertIs(site, self.app.settings['site'])
+        self.assertEqual(failures + 1, REGISTRY.get_sample_value(
+            'site_reload_failures_total'))
+        self.assertIn(b'<h1>First</h1>', self.fetch('/').body)
+
+    def test_unknown_vary_dimension_rejected(self):
+        for vary in ('[headers]', '[hots]', 'host'):
+            self.write_site(
+                f'/: {{title: "Cached", response_cache: {{vary: {vary}}}}}')
+            self.assertFalse(self.reloader.reload())
+
+        self.write_site(
+            '/: {title: "Cached", response_cache: {vary: [host, path]}}')
+        self.assertTrue(self.reloader.reload())
+
+    def test_invalid_timeout_rejected(self):
+        source = '/: {{data_sources_concurrency: {concurrency}, ' \
+            'data_sources: {{items: {{src: "http://localhost/", ' \
+            'format: json, timeout: {timeout}}}}}}}'
+        for concurrency, timeout in (('1', '"abc"'), ('1', '0'),
+                                     ('0', '1'), ('1.5', '1'), ('"2"', '1')):
+            self.write_site(source.format(
+                concurrency=concurrency, timeout=timeout))
+            self.assertFalse(self.reloader.reload())
+
+        self.write_site(source.format(concurrency='2', timeout='0.5'))
+        self.assertTrue(self.reloader.reload())
+
+    def test_invalid_data_cache_rejected(self):
+        source = '/: {{data_sources: {{items: {{src: "http://localhost/", ' \
+            'format: json, cache: {cache}}}}}}}'
+        for cache in ('{ttl: 60, stale: 5}', '{ttl: "60"}',
+                      '{stale_ttl: -1}', '{max_entries: 0}', '60'):
+            self.write_site(source.format(cache=cache))
+            self.assertFalse(self.reloader.reload())
+
+        self.write_site(source.format(
+            cache='{ttl: 60, stale_ttl: 0.5, max_entries: 10}'))
+        self.assertTrue(self.reloader.reload())
+
+
+class TestProfileHandler(AsyncHTTPTestCase):
+
+    def get_app(self):
+        return tornado.web.Application([
+            (r"/admin/profile", ProfileHandler),
+            (r"/blocking", BlockingHandler)], admin_token='secret')
+
+    def test_needs_token(self):
+        self.assertEqual(403, self.fetch('/admin/profile?seconds=0.1').code)
+        self.assertEqual(403, self.fetch(
+            '/admin/profile?seconds=0.1',
+            headers={'Authorization': 'Bearer wrong'}).code)
+
+        self._app.settings['admin_token'] = None
+        self.assertEqual(404, self.fetch(
+            '/admin/profile?seconds=0.1',
+            headers={'Authorization': 'Bearer secret'}).code)
+
+    def test_interval_bounded(self):
+        for interval in ('0', '1e-9', 'nan'):
+            response = self.fetch(
+                f'/admin/profile?seconds=0.1&interval={interval}',
+                headers={'Authorization': 'Bearer secret'})
+            self.assertEqual(400, response.code)
+
+    def test_threshold_bounded(self):
+        for threshold in ('0', '-1', 'nan'):
+            response = self.fetch(
+                f'/admin/profile?seconds=0.1&threshold={threshold}',
+                headers={'Authorization': 'Bearer secret'})
+            self.assertEqual(400, response.code)
+
+    @gen_test
+    def test_profile(self):
+        url = self.get_url('/admin/profile?seconds=0.5&threshold=0.1')
+        collapsed = self.http_client.fetch(
+            url, headers={'Authorization': 'Bearer secret'})
+        profile = self.http_client.fetch(
+            url + '&format=json', headers={'Authorization': 'Bearer secret'},
+            raise_error=False)
+
+        yield tornado.gen.sleep(0.1)
+        yield self.http_client.fetch(self.get_url('/blocking?delay=0.2'))
+        collapsed, profile = yield [collapsed, profile]
+
+        # only one profile runs at a time
+        self.assertEqual(409, profile.code)
+
+        self.assertEqual('text/plain; charset=UTF-8',
+                         collapsed.headers['Content-Type'])
+        stacks = {}
+        for line in collapsed.body.decode().splitlines():
+            stack, count = line.rsplit(' ', 1)
+            stacks[stack] = int(count)
+        # sampled while the loop was blocked in BlockingHandler.get
+        self.assertTrue(any(
+            stack.startswith('MainThread;') and stack.endswith(':get')
+            for stack in stacks))
+
+    @gen_test
+    def test_blocking_callbacks(self):
+        url = self.get_url('/admin/profile?seconds=0.5&format=json')
+        profile = self.http_client.fetch(
+            url, headers={'Authorization': 'Bearer secret'})
+
+        yield tornado.gen.sleep(0.1)
+        yield self.http_client.fetch(self.get_url('/blocking?delay=0.2'))
+        profile = json.loads((yield profile).body)
+
+        self.assertGreater(profile['samples'], 0)
+        self.assertEqual(1, len(profile['blocking']))
+        blocking = profile['blocking'][0]
+        self.assertGreaterEqual(blocking['seconds'], 0.15)
+        self.assertTrue(blocking['stack'].endswith(':get'))
+
+
+class TestPrefetcher(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        site_path = os.path.join(self.tmp.name, 'site.yaml')
+        url = f'http://localhost:{self.get_http_port()}'
+        with open(site_path, 'w') as f:
+            f.write(f'''
+pages:
+  /prefetched:
+    tpl_name: "/json.html"
+    data_sources:
+      counter:
+        format: "json"
+        src: "{url}/counter"
+        cache: {{ttl: 60}}
+        refresh_interval: 0.1
+      uncached:
+        format: "json"
+        src: "{url}/counter?uncached"
+        refresh_interval: 0.1
+  /templated/(?P<name>.*):
+    data_sources:
+      counter:
+        format: "json"
+        src: "{url}/counter?{{name}}"
+        cache: {{ttl: 60}}
+        refresh_interval: 0.1
+''')
+
+        settings = dict(test_app.settings)
+        settings['site'] = init_site(site_path)
+        self.app = tornado.web.Application(
+            [(r"/counter", CounterHandler),
+             (r"(/[a-z0-9\-_\/\.]*)$", PageHandler)], **settings)
+        return self.app
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        super(TestPrefetcher, self).tearDown()
+
+    def test_refreshes_declared_sources(self):
+        url = f'http://localhost:{self.get_http_port()}/counter'
+        labels = {'source': url, 'result': 'success'}
+        before = REGISTRY.get_sample_value(
+            'data_prefetch_total', labels) or 0
+
+        prefetcher = Prefetcher(self.app, resolution=0.02)
+        self.assertEqual([url], [key[0] for key in prefetcher.sources()])
+
+        count = CounterHandler.count
+        prefetcher.start()
+        self.io_loop.run_sync(lambda: tornado.gen.sleep(0.35))
+        prefetcher.stop()
+
+        # started right away, then every 0.1 +- 0.01 seconds
+        refreshes = REGISTRY.get_sample_value(
+            'data_prefetch_total', labels) - before
+        self.assertGreaterEqual(refreshes, 3)
+        self.assertLessEqual(refreshes, 4)
+        self.assertEqual(count + refreshes, CounterHandler.count)
+
+        cache = Engine.for_application(self.app).get_data_cache(
+            self.app.settings['site']['pages']['/prefetched']
+            ['data_sources']['counter'])
+        self.assertEqual({'count': CounterHandler.count},
+                         cache.entries.get((url, 'json', None)).value)
+
+
+class TestUpstreamClient(AsyncHTTPTestCase):
+
+    def get_app(self):
+        return tornado.web.Application([
+            (r"/slow", SlowHandler),
+            (r"/error", ErrorHandler)])
+
+    @gen_test
+    def test_connections_limited_per_host(self):
+        client = UpstreamClient(max_per_host=1)
+        url = self.get_url('/slow?delay=0.1')
+
+        start = time()
+        yield [client.fetch(tornado.httpclient.HTTPRequest(url))
+               for _ in range(3)]
+        self.assertGreaterEqual(time() - start, 0.3)
+
+        host = f'127.0.0.1:{self.get_http_port()}'
+        self.assertEqual(3, REGISTRY.get_sample_value(
+            'upstream_queue_wait_seconds_count', {'host': host}))
+
+    @gen_test
+    def test_circuit_opens_on_server_errors(self):
+        client = UpstreamClient(breaker={'failures': 2, 'reset_timeout': 60})
+        url = self.get_url('/error')
+
+        for _ in range(2):
+            with self.assertRaises(tornado.httpclient.HTTPClientError):
+                yield client.fetch(tornado.httpclient.HTTPRequest(url))
+
+        requests = ErrorHandler.requests
+        with self.assertRaises(CircuitOpenError):
+            yield client.fetch(tornado.httpclient.HTTPRequest(url))
+        self.assertEqual(requests, ErrorHandler.requests)
+
+
+class TestProjection(unittest.TestCase):
+    feed = ('<?xml version="1.0"?><rss version="2.0"><channel>'
+            '<title>Feed</title>' +
+            ''.join(f'<item><title>Item {i}</title>'
+                    f'<link>https://example.com/{i}</link></item>'
+                    for i in range(5)) +
+            '</channel></rss>')
+
+    def test_json_stops_after_limit(self):
+        # everything after the second item is never decoded
+        data = b'[{"a": 1, "b": 2}, {"a": 3, "b": 4}, not json'
+        self.assertEqual(
+            [{'a': 1}, {'a': 3}],
+            parse_data('json', data, Projection(2, ('a',))))
+
+        self.assertEqual(
+            {'a': 1}, parse_data('json', '{"a": 1}', Projection(2, None)))
+        self.assertEqual([], parse_data('json', ' [ ] ', Projection(2, None)))
+
+    def test_yaml(self):
+        self.assertEqual(
+            [{'a': 1}], parse_data('yaml', '- {a: 1, b: 2}\n- {a: 3}\n',
+                                   Projection(1, ('a',))))
+
+    def test_rss(self):
+        truncated = truncate_feed(self.feed, 2)
+        self.assertNotIn('Item 2', truncated)
+        self.assertTrue(truncated.endswith('</channel></rss>'))
+        self.assertEqual(self.feed, truncate_feed(self.feed, 5))
+
+        feed = parse_data('rss', self.feed.encode(),
+                          Projection(2, ('title', 'link')))
+        self.assertEqual('Feed', feed['feed']['title'])
+        self.assertEqual(
+            [{'title': 'Item 0', 'link': 'https://example.com/0'},
+             {'title': 'Item 1', 'link': 'https://example.com/1'}],
+            feed['entries'])
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_half_open_after_reset_timeout(self):
+        breaker = CircuitBreaker(failures=1, reset_timeout=0)
+        breaker.failure()
+        self.assertTrue(breaker.open)
+
+        # a single trial request is let through
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+
+        breaker.success()
+        self.assertFalse(breaker.open)
+        self.assertTrue(breaker.allow())
+
+    def test_failed_trial_reopens(self):
+        breaker = CircuitBreaker(failures=1, reset_timeout=60)
+        breaker.failure()
+        breaker.opened_at -= 60
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+
+
+class TestDataExecutor(AsyncTestCase):
+
+    @gen_test
+    def test_thread_executor(self):
+        executor = DataExecutor('thread', 1)
+        parsed = yield executor.submit(parse_data, 'json', '{"key": 1}')
+        self.assertEqual({'key': 1}, parsed)
+        executor.shutdown()
+
+    @gen_test
+    def test_process_executor(self):
+        executor = DataExecutor('process', 1)
+        parsed = yield executor.submit(parse_data, 'yaml', 'key: 1')
+        self.assertEqual({'key': 1}, parsed)
+        executor.shutdown()
+
+
+class TestRouteIndex(unittest.TestCase):
+
+    def linear_match(self, patterns, slug):
+        for route in RouteIndex(patterns).routes:
+            match = route.fullmatch(slug)
+            if match:
+                return route.pattern, match.groupdict()
+        return None
+
+    def indexed_match(self, index, slug):
+        result = index.match(slug)
+        if result is None:
+            return None
+        route, match = result
+        return route.pattern, match.groupdict()
+
+    def test_literal_prefix(self):
+        self.assertEqual(('/', True), literal_prefix('/'))
+        self.assertEqual(('/a-b_c', True), literal_prefix('/a-b_c'))
+        self.assertEqual(('/sitemap.xml', True),
+                         literal_prefix(r'/sitemap\.xml'))
+        self.assertEqual(('/sitemap', False), literal_prefix('/sitemap.xml'))
+        self.assertEqual(('/data/', False),
+                         literal_prefix('/data/(?P<port>[0-9]+)'))
+        self.assertEqual(('/ab', False), literal_prefix('/abc?'))
+        self.assertEqual(('/abc', False), literal_prefix('/abc+'))
+        self.assertEqual(('', False), literal_prefix('/a|/b'))
+        self.assertEqual(('', False), literal_prefix('(?i)/a'))
+
+    def test_same_matches_as_linear_scan(self):
+        patterns = list(test_app.settings['site']['pages'])
+        patterns += ['/shadowed/.*', '/shadowed/page', '/abc?', '/ab']
+        index = RouteIndex(patterns)
+
+        slugs = ['/', '/test-assets', '/unknown', '/data-sources/8080',
+                 '/data-sources/', '/test-wildcard_slugs/a/b/c/test',
+                 '/test-wildcard_slugs/a/b/test',
+                 '/test-wildcard_slugs/a/test',
+                 '/test-wildcard_slugs-data_source/name',
+                 '/test_two_named_groups/path1/file', '/sitemap.xml',
+                 '/sitemapXxml', '/shadowed/page', '/ab', '/abc', '/a',
+                 '/404', '']
+        for slug in slugs:
+            self.assertEqual(
+                self.linear_match(patterns, slug),
+                self.indexed_match(index, slug),
+                slug)
+
+    def test_literal_slugs_are_looked_up_directly(self):
+        index = RouteIndex(['/.*-x', '/a', '/b-x'])
+        self.assertIn('/a', index.exact)
+        self.assertEqual('/a', index.match('/a')[0].pattern)
+        self.assertEqual('/.*-x', index.match('/b-x')[0].pattern)
+
+
+class TestDataCache(AsyncTestCase):
+
+    def setUp(self):
+        super(TestDataCache, self).setUp()
+        self.calls = 0
+
+    @tornado.gen.coroutine
+    def fetch(self, previous):
+        self.calls += 1
+        yield tornado.gen.sleep(0.01)
+        return self.calls, {}
+
+    def test_lru_eviction(self):
+        cache = LRUCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+
+    @gen_test
+    def test_concurrent_misses_are_coalesced(self):
+        cache = DataCache(ttl=60)
+        values = yield [cache.get('key', self.fetch) for _ in range(5)]
+        self.assertEqual([1] * 5, values)
+        self.assertEqual(1, self.calls)
+
+    @gen_test
+    def test_stale_while_revalidate(self):
+        cache = DataCache(ttl=0, stale_ttl=60)
+        value = yield cache.get('key', self.fetch)
+        self.assertEqual(1, value)
+
+        # the stale value is served while a refresh runs in the background
+        value = yield cache.get('key', self.fetch)
+        self.assertEqual(1, value)
+        yield tornado.gen.sleep(0.05)
+        self.assertEqual(2, self.calls)
+
+    @gen_test
+    def test_expired_entries_are_refetched(self):
+        cache = DataCache(ttl=0, stale_ttl=0)
+        yield cache.get('key', self.fetch)
+        value = yield cache.get('key', self.fetch)
+        self.assertEqual(2, value)